@@ -0,0 +1,118 @@
+"""Loading, compiling and caching of the organizer configuration"""
+import json
+import os
+from copy import deepcopy
+
+import yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # pragma: no cover - libyaml is not available everywhere
+    from yaml import SafeLoader
+
+from models.schema import (
+    ORGANIZATION_KEYS,
+    ConfigurationError,
+    OrganizerConfig,
+    validate_configuration,
+)
+
+# Bump whenever the compiled layout changes so stale cache files are ignored
+COMPILED_CONFIG_VERSION = 2
+CONFIG_CACHE_DIR = os.getenv(
+    "ORGANIZER_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "github-organizer"),
+)
+MAX_EXTENDS_DEPTH = 5
+OLD_STYLE_FEATURES = ["has_issues", "has_wiki", "has_downloads", "has_projects"]
+OLD_STYLE_MERGES = ["allow_rebase_merge", "allow_squash_merge", "allow_merge_commit"]
+
+
+def load_configuration(content) -> OrganizerConfig:
+    """Parse and compile the raw contents of an organizer.yaml file"""
+    return compile_configuration(yaml.load(content, Loader=SafeLoader))
+
+
+def compile_configuration(config: dict) -> OrganizerConfig:
+    """Validate a parsed configuration and compile it with flattened profiles"""
+    if isinstance(config, dict) and "repositories" not in config:
+        config = convert_old_style_configuration(config)
+    errors = validate_configuration(config)
+    if errors:
+        raise ConfigurationError(errors)
+    repositories = config.get("repositories") or {}
+    config = dict(config)
+    config["repositories"] = {
+        name: resolve_profile(repositories, name) for name in repositories
+    }
+    return OrganizerConfig(config)
+
+
+def convert_old_style_configuration(config: dict) -> dict:
+    """Convert from the old style configuration to the current version"""
+    converted = {key: config[key] for key in config if key in ORGANIZATION_KEYS}
+    settings = {key: config[key] for key in config if key not in ORGANIZATION_KEYS}
+    settings["features"] = {}
+    settings["merges"] = {}
+    for feature in OLD_STYLE_FEATURES:
+        if feature in settings:
+            settings["features"][feature] = settings.pop(feature)
+    for merge in OLD_STYLE_MERGES:
+        if merge in settings:
+            settings["merges"][merge] = settings.pop(merge)
+    converted["repositories"] = {"default": settings}
+    return converted
+
+
+def resolve_profile(repositories: dict, name: str, maxdepth=MAX_EXTENDS_DEPTH):
+    """Flatten a repository profile by applying it on top of the one it extends"""
+    settings = repositories.get(name)
+    if not settings:
+        return None
+    if isinstance(settings, str):
+        settings = {"extends": settings}
+    settings = deepcopy(settings)
+    parent_name = settings.pop("extends", None)
+    if parent_name and maxdepth > 0:
+        parent = resolve_profile(repositories, parent_name, maxdepth - 1)
+        if parent:
+            parent.update(settings)
+            settings = parent
+    return settings
+
+
+def get_cache_path(login: str) -> str:
+    """Get the path of the compiled configuration cache for an organization"""
+    return os.path.join(CONFIG_CACHE_DIR, f"{login.lower()}.json")
+
+
+def read_cached_configuration(login: str, sha: str):
+    """Get the compiled configuration if it was cached for the given commit"""
+    try:
+        with open(get_cache_path(login), "r", encoding="utf-8") as file:
+            cached = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if cached.get("version") != COMPILED_CONFIG_VERSION or cached.get("sha") != sha:
+        return None
+    return OrganizerConfig(cached["config"])
+
+
+def write_cached_configuration(login: str, sha: str, config: OrganizerConfig):
+    """Store the compiled configuration for the given commit"""
+    path = get_cache_path(login)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so concurrent runs never read a partial file
+        with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "version": COMPILED_CONFIG_VERSION,
+                    "sha": sha,
+                    "config": config.to_dict(),
+                },
+                file,
+            )
+        os.replace(f"{path}.tmp", path)
+    except OSError as exception:
+        print(f"Unable to cache the configuration for {login}: {exception}")
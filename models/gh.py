@@ -1,17 +1,171 @@
 """Models for Organizer"""
-from copy import copy
+import base64
+import fnmatch
+from types import SimpleNamespace
 
-import yaml
-from github import Branch, Organization, Repository
-from github.GithubException import GithubException
+from github import Branch, Organization, Repository, Team
+from github.GithubException import GithubException, UnknownObjectException
 from github.GithubObject import NotSet
 
-DEFAULT_LABEL_COLOR = "000000"
+from models.config import (
+    load_configuration,
+    read_cached_configuration,
+    write_cached_configuration,
+)
+from models.profiling import phase, timed
+from models.schema import (
+    PERMISSIONS,
+    BranchPolicy,
+    ConfigurationError,
+    LabelConfig,
+    OrganizerConfig,
+    RepositoryProfile,
+)
+
 CACHE_SHORT = 5 * 60  # Five minutes
 CACHE_MEDIUM = 60 * 60  # One hour
 CACHE_LONG = 24 * 60 * 60  # One day
 GLOBAL_CONFIG = None
 
+# Maps the `dependency_security` keys to the organization "enable for all" products
+SECURITY_PRODUCTS = {
+    "alerts": "dependabot_alerts",
+    "automatic_fixes": "dependabot_security_updates",
+}
+
+VULNERABILITY_ALERTS_QUERY = """
+query($login: String!, $cursor: String) {
+  organization(login: $login) {
+    repositories(first: 100, after: $cursor) {
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+      nodes {
+        name
+        hasVulnerabilityAlertsEnabled
+      }
+    }
+  }
+}
+"""
+
+# Repository flags missing from the organization listing, by their GraphQL field
+SETTING_FIELDS = {
+    "allow_squash_merge": "squashMergeAllowed",
+    "allow_merge_commit": "mergeCommitAllowed",
+    "allow_rebase_merge": "rebaseMergeAllowed",
+    "allow_auto_merge": "autoMergeAllowed",
+    "delete_branch_on_merge": "deleteBranchOnMerge",
+    "squash_merge_commit_title": "squashMergeCommitTitle",
+    "squash_merge_commit_message": "squashMergeCommitMessage",
+    "merge_commit_title": "mergeCommitTitle",
+    "merge_commit_message": "mergeCommitMessage",
+    "allow_forking": "forkingAllowed",
+    "web_commit_signoff_required": "webCommitSignoffRequired",
+}
+
+# Branch rulesets of a repository, including the ones of the organization
+RULESET_FIELDS = """
+rulesets(first: 50, includeParents: true) {
+  nodes {
+    enforcement
+    target
+    conditions {
+      refName {
+        include
+        exclude
+      }
+    }
+  }
+}
+"""
+
+# Aliases make the nodes use the same keys as the REST API, get_record_data
+# flattens the rest
+REPOSITORY_RECORDS_QUERY = """
+query($ids: [ID!]!) {
+  nodes(ids: $ids) {
+    ... on Repository {
+      node_id: id
+      name
+      fork: isFork
+      archived: isArchived
+      created_at: createdAt
+      has_issues: hasIssuesEnabled
+      has_projects: hasProjectsEnabled
+      has_wiki: hasWikiEnabled
+      %s
+      repositoryTopics(first: 20) {
+        nodes {
+          topic {
+            name
+          }
+        }
+      }
+      defaultBranchRef {
+        name
+        branchProtectionRule {
+          id
+        }
+      }
+      %s
+    }
+  }
+}
+""" % (
+    "\n      ".join(f"{key}: {field}" for key, field in SETTING_FIELDS.items()),
+    RULESET_FIELDS,
+)
+
+LABEL_FIELDS = """
+labels(first: 100, after: $labelCursor) {
+  pageInfo {
+    hasNextPage
+    endCursor
+  }
+  nodes {
+    id
+    name
+    color
+    description
+  }
+}
+"""
+
+# Other repository fields can be added next to the labels with a format string
+REPOSITORY_NODES_QUERY = """
+query($login: String!, $cursor: String, $labelCursor: String) {
+  organization(login: $login) {
+    repositories(first: 50, after: $cursor) {
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+      nodes {
+        node_id: id
+        name
+        fork: isFork
+        archived: isArchived
+        %s
+      }
+    }
+  }
+}
+"""
+
+REPOSITORY_LABELS_QUERY = REPOSITORY_NODES_QUERY % (LABEL_FIELDS)
+
+LABELS_PAGE_QUERY = """
+query($login: String!, $name: String!, $labelCursor: String) {
+  repository(owner: $login, name: $name) {
+    %s
+  }
+}
+""" % (
+    LABEL_FIELDS
+)
+
 
 def update_global_config(config: dict):
     """Update the global config when using a local file"""
@@ -43,27 +197,42 @@ def update_global_config(config: dict):
 #     return len(results["data"]["repository"]["issue"]["projectCards"]["edges"]) > 0
 
 
-# def team_has_repositories(installation, team):
-#     # GET /teams/:team_id/repos
-#     results = installation.rest(
-#         "get",
-#         "teams/%s/repos" % (team.id),
-#         payload=False,
-#         accepts=["application/vnd.github.hellcat-preview+json"],
-#     )
-#     repositories = {}
-#     for repo in results:
-#         repositories[repo["name"]] = []
-#         for permission in repo["permissions"]:
-#             if repo["permissions"][permission]:
-#                 repositories[repo["name"]].append(permission)
-#     return repositories
+def get_listing_pages(organization: Organization, budget=None):
+    """Yield the repositories of an organization one listing page at a time"""
+    # Iterating a PaginatedList keeps every page around, so fetch pages explicitly
+    repositories = organization.get_repos()
+    per_page = organization._requester.per_page
+    page = 0
+    while True:
+        # A run budget stops the listing before a request it can't afford
+        if budget and not budget.read():
+            return
+        with phase("inventory"):
+            listing = repositories.get_page(page)
+        yield listing
+        if len(listing) < per_page:
+            return
+        page += 1
+
+
+def get_team_repository_permissions(team: Team) -> dict:
+    """Get the permission a team has on each of its repositories in one listing"""
+    # GET /orgs/:org/teams/:team_slug/repos
+    repositories = {}
+    for repo in team.get_repos():
+        permissions = repo._rawData.get("permissions") or {}
+        for permission in reversed(PERMISSIONS):
+            if permissions.get(permission):
+                repositories[repo.name] = permission
+                break
+    return repositories
 
 
 class OrganizerOrganization:
     """Class to represent a Github Organization"""
 
     configuration = None
+    has_configuration = True
 
     def __repr__(self):
         return "OrganizerOrganization %s" % self.name
@@ -74,10 +243,11 @@ class OrganizerOrganization:
     def __init__(self, organization: Organization):
         """Initialize Class"""
         self.org = organization
-        self.configuration = self.get_configuration()
         self.name = organization.name
         self.login = organization.login
+        self.configuration = self.get_configuration()
 
+    @timed("inventory")
     def get_repository(self, name: str):
         """Get a specific repository from the organization"""
         try:
@@ -86,7 +256,8 @@ class OrganizerOrganization:
         except Exception:
             return None
 
-    def get_configuration(self):
+    @timed("config load")
+    def get_configuration(self) -> OrganizerConfig:
         """Get the configuration for the organization"""
         if GLOBAL_CONFIG is not None:
             self.configuration = GLOBAL_CONFIG
@@ -94,38 +265,229 @@ class OrganizerOrganization:
         if self.configuration is not None:
             return self.configuration
         try:
-            config_repository = self.org.get_repo(".github")
-            return yaml.safe_load(
-                config_repository.get_contents("organizer.yaml").decoded_content
+            sha = self.get_configuration_sha()
+        except UnknownObjectException:
+            return self.get_missing_configuration()
+        except GithubException as exception:
+            raise ConfigurationError(
+                [f"Unable to fetch the configuration of {self.login}: {exception}"]
+            ) from exception
+        # The compiled configuration only changes when the .github repository does
+        config = read_cached_configuration(self.login, sha)
+        if config is not None:
+            return config
+        try:
+            _, data = self.org._requester.requestJsonAndCheck(
+                "GET",
+                f"/repos/{self.login}/.github/contents/organizer.yaml",
+                parameters={"ref": sha},
             )
-        except Exception:
-            try:
-                config_repository = self.org.get_repo(".github")
-                return yaml.safe_load(
-                    config_repository.get_contents("organizer.yaml").decoded_content
-                )
-            except Exception:
-                return False
+        except UnknownObjectException:
+            return self.get_missing_configuration()
+        except GithubException as exception:
+            raise ConfigurationError(
+                [f"Unable to fetch the configuration of {self.login}: {exception}"]
+            ) from exception
+        config = load_configuration(base64.b64decode(data["content"]))
+        write_cached_configuration(self.login, sha, config)
+        return config
+
+    def get_missing_configuration(self) -> OrganizerConfig:
+        """Get the empty configuration used when organizer.yaml does not exist"""
+        print(f"No organizer.yaml in {self.login}/.github, nothing is managed")
+        self.has_configuration = False
+        return OrganizerConfig({})
+
+    def get_configuration_sha(self) -> str:
+        """Get the HEAD commit SHA of the .github repository"""
+        _, data = self.org._requester.requestJsonAndCheck(
+            "GET", f"/repos/{self.login}/.github/commits/HEAD"
+        )
+        return data["sha"]
+
+    def is_excluded(self, repository: Repository) -> bool:
+        """Check if a repository is excluded by the configuration"""
+        if repository.name in self.configuration.exclude_repositories:
+            return True
+        if self.configuration.exclude_forks and repository.fork:
+            return True
+        if self.configuration.exclude_archived and repository.archived:
+            return True
+        return False
 
     def get_repositories(self):
         """Get all repositories for the organizations"""
         for repository in self.org.get_repos():
-            if "exclude_repositories" in self.configuration:
-                if repository.name in self.configuration["exclude_repositories"]:
-                    continue
-            if self.configuration.get("exclude_forks", False) and repository.fork:
-                continue
-            if (
-                self.configuration.get("exclude_archived", False)
-                and repository.archived
-            ):
+            if self.is_excluded(repository):
                 continue
             yield OrganizerRepository(self, repository)
 
+    def get_profile_name(self, name: str, topics: list) -> str:
+        """Get the name of the settings profile used by a repository"""
+        topic_assignment = False
+        if self.configuration.topics_for_assignment:
+            topic_assignments = [x for x in topics if x.startswith("gho-")]
+            if len(topic_assignments) == 1:
+                topic_assignment = topic_assignments[0][4:]
+
+        profiles = self.configuration.repositories
+        if topic_assignment and topic_assignment in profiles:
+            return topic_assignment
+        if name in profiles:
+            return name
+        if "default" in profiles:
+            return "default"
+        return None
+
+    @timed("resolve")
+    def get_profile(self, name: str, topics: list) -> RepositoryProfile:
+        """Get the settings profile for a repository, shared between repositories"""
+        # Profiles are flattened when the configuration is compiled
+        return self.configuration.repositories.get(self.get_profile_name(name, topics))
+
+    def get_team_permissions(self, name: str, topics: list) -> dict:
+        """Get the permission each configured team should have on a repository"""
+        profile = self.get_profile_name(name, topics)
+        permissions = {}
+        for slug, team in self.configuration.teams.items():
+            permission = team.repositories.get(name) or team.profiles.get(profile)
+            if permission:
+                permissions[slug] = permission
+        return permissions
+
+    def graphql(self, query: str, variables: dict = None, headers=None) -> dict:
+        """Run a GraphQL query against the API and return the raw response"""
+        _, data = self.org._requester.requestJsonAndCheck(
+            "POST",
+            "/graphql",
+            headers=headers,
+            input={"query": query, "variables": variables or {}},
+        )
+        return data
+
+    def get_repository_labels(self, query: str = REPOSITORY_LABELS_QUERY):
+        """Yield every repository with its labels, 50 repositories per request"""
+        cursor = None
+        while True:
+            response = self.graphql(query, {"login": self.login, "cursor": cursor})
+            if response.get("errors"):
+                raise GithubException(400, response["errors"], None)
+            repositories = response["data"]["organization"]["repositories"]
+            for node in repositories["nodes"]:
+                labels = node.pop("labels")
+                node["labels"] = {x["name"]: x for x in labels["nodes"]}
+                if labels["pageInfo"]["hasNextPage"]:
+                    self.get_remaining_labels(node, labels["pageInfo"]["endCursor"])
+                yield node
+            if not repositories["pageInfo"]["hasNextPage"]:
+                return
+            cursor = repositories["pageInfo"]["endCursor"]
+
+    def get_remaining_labels(self, node: dict, cursor: str):
+        """Add the labels past the first page to a repository node"""
+        while cursor:
+            response = self.graphql(
+                LABELS_PAGE_QUERY,
+                {"login": self.login, "name": node["name"], "labelCursor": cursor},
+            )
+            if response.get("errors"):
+                raise GithubException(400, response["errors"], None)
+            labels = response["data"]["repository"]["labels"]
+            node["labels"].update({x["name"]: x for x in labels["nodes"]})
+            cursor = (
+                labels["pageInfo"]["hasNextPage"] and labels["pageInfo"]["endCursor"]
+            )
+
+    @timed("diff")
+    def get_label_mutations(self, node: dict) -> list:
+        """Get the label mutations needed to bring a repository in line"""
+        labels = node["labels"]
+        config_labels = self.configuration.labels
+        mutations = []
+
+        # Remove any labels not in the configuration
+        if self.configuration.labels_clean:
+            # Labels about to be renamed are kept as well
+            label_names = [x.name for x in config_labels]
+            label_names += [x.old_name for x in config_labels if x.old_name]
+            for name, label in labels.items():
+                if name not in label_names:
+                    mutations.append((name, "deleteLabel", {"id": label["id"]}))
+
+        for config_label in config_labels:
+            fields = {"name": config_label.name, "color": config_label.color}
+            if config_label.description is not None:
+                fields["description"] = config_label.description
+            if config_label.old_name and config_label.old_name in labels:
+                label = labels[config_label.old_name]
+                mutations.append(
+                    (config_label.name, "updateLabel", {"id": label["id"], **fields})
+                )
+            elif config_label.name in labels:
+                label = labels[config_label.name]
+                if not label_matches(config_label, SimpleNamespace(**label)):
+                    mutations.append(
+                        (
+                            config_label.name,
+                            "updateLabel",
+                            {"id": label["id"], **fields},
+                        )
+                    )
+            else:
+                mutations.append(
+                    (
+                        config_label.name,
+                        "createLabel",
+                        {"repositoryId": node["node_id"], **fields},
+                    )
+                )
+        return mutations
+
+    @timed("inventory")
+    def get_vulnerability_alert_states(self) -> dict:
+        """Get the vulnerability alert state of every repository, 100 per request"""
+        states = {}
+        cursor = None
+        while True:
+            response = self.graphql(
+                VULNERABILITY_ALERTS_QUERY, {"login": self.login, "cursor": cursor}
+            )
+            if response.get("errors"):
+                raise GithubException(400, response["errors"], None)
+            repositories = response["data"]["organization"]["repositories"]
+            for node in repositories["nodes"]:
+                states[node["name"]] = node["hasVulnerabilityAlertsEnabled"]
+            if not repositories["pageInfo"]["hasNextPage"]:
+                return states
+            cursor = repositories["pageInfo"]["endCursor"]
+
+    @timed("inventory")
+    def get_repository_records(self, node_ids: list) -> list:
+        """Get the record data of up to 100 repositories by node ID in one request"""
+        if not node_ids:
+            return []
+        response = self.graphql(REPOSITORY_RECORDS_QUERY, {"ids": node_ids})
+        # Repositories deleted since they were listed come back as null nodes
+        errors = [
+            x for x in response.get("errors") or [] if x.get("type") != "NOT_FOUND"
+        ]
+        if errors or not response.get("data"):
+            raise GithubException(400, errors or response.get("errors"), None)
+        return [get_record_data(x) for x in response["data"]["nodes"] if x]
+
+    def toggle_security_product(self, setting: str, enable: bool):
+        """Enable or disable a security setting for every repository in the organization"""
+        enablement = "enable_all" if enable else "disable_all"
+        self.org._requester.requestJsonAndCheck(
+            "POST", f"{self.org.url}/{SECURITY_PRODUCTS[setting]}/{enablement}"
+        )
+
 
 class OrganizerRepository:
     """Class representing a GitHub Repository"""
 
+    __slots__ = ("organization", "repository", "name", "_settings")
+
     def __repr__(self):
         return "OrganizerRepository %s/%s" % (self.organization.name, self.name)
 
@@ -142,69 +504,28 @@ class OrganizerRepository:
     def update_settings(self):
         """Update General repositiroy settings"""
         organizer_settings = self.get_organizer_settings()
-        self.repository.edit(
-            has_issues=organizer_settings.get("features", {}).get("has_issues", NotSet),
-            has_projects=organizer_settings.get("features", {}).get(
-                "has_projects", NotSet
-            ),
-            has_wiki=organizer_settings.get("features", {}).get("has_wiki", NotSet),
-            allow_forking=organizer_settings.get("features", {}).get(
-                "allow_forking", NotSet
-            ),
-            web_commit_signoff_required=organizer_settings.get("features", {}).get(
-                "web_commit_signoff_required", NotSet
-            ),
-            # has_downloads = organizer_settings.get('features', {}).get('has_downloads', NotSet),
-            allow_squash_merge=organizer_settings.get("merges", {}).get(
-                "allow_squash_merge", NotSet
-            ),
-            allow_merge_commit=organizer_settings.get("merges", {}).get(
-                "allow_merge_commit", NotSet
-            ),
-            allow_rebase_merge=organizer_settings.get("merges", {}).get(
-                "allow_rebase_merge", NotSet
-            ),
-            allow_auto_merge=organizer_settings.get("merges", {}).get(
-                "allow_auto_merge", NotSet
-            ),
-            delete_branch_on_merge=organizer_settings.get("merges", {}).get(
-                "delete_branch_on_merge", NotSet
-            ),
-            allow_update_branch=organizer_settings.get("merges", {}).get(
-                "allow_update_branch", NotSet
-            ),
-            use_squash_pr_title_as_default=organizer_settings.get("merges", {}).get(
-                "use_squash_pr_title_as_default", NotSet
-            ),
-            squash_merge_commit_title=organizer_settings.get("merges", {}).get(
-                "squash_merge_commit_title", NotSet
-            ),
-            squash_merge_commit_message=organizer_settings.get("merges", {}).get(
-                "squash_merge_commit_message", NotSet
-            ),
-            merge_commit_title=organizer_settings.get("merges", {}).get(
-                "merge_commit_title", NotSet
-            ),
-            merge_commit_message=organizer_settings.get("merges", {}).get(
-                "merge_commit_message", NotSet
-            ),
-        )
+        if not organizer_settings:
+            return
+        changes = dict(organizer_settings.features or {})
+        # has_downloads is deprecated and not accepted by the API anymore
+        changes.pop("has_downloads", None)
+        changes.update(organizer_settings.merges or {})
+        if changes:
+            with phase("write"):
+                self.repository.edit(**changes)
 
     def update_default_branch(self):
         """Update Default Branch for a repository"""
         org_settings = self.get_organizer_settings()
-        if "branches" not in org_settings:
+        if not org_settings or not org_settings.branches:
             return
 
         # If this repo is a fork then leave it alone.
         if self.repository.source:
             return
 
-        for branch in org_settings["branches"]:
-            settings = org_settings["branches"][branch]
-            if "default" not in settings:
-                continue
-            if not settings["default"]:
+        for branch, settings in org_settings.branches.items():
+            if not settings.default:
                 continue
             if self.repository.default_branch == branch:
                 return
@@ -216,7 +537,8 @@ class OrganizerRepository:
             # except:
             #     pass
             try:
-                self.repository.edit(default_branch=branch)
+                with phase("write"):
+                    self.repository.edit(default_branch=branch)
             except Exception:
                 pass
 
@@ -231,108 +553,62 @@ class OrganizerRepository:
         """Get topics for a repository"""
         return self.repository.get_topics()
 
-    def get_organizer_settings(self, name=False, maxdepth=5):
+    def get_organizer_settings(self) -> RepositoryProfile:
         """Get organizaer settings for a repository"""
         if self._settings is not None:
             return self._settings
-        topic_assignment = False
-        if self.organization.configuration.get("topics_for_assignment", True):
-            topics = self.get_topics()
-            topic_assignments = [x for x in topics if x.startswith("gho-")]
-            if len(topic_assignments) == 1:
-                topic_assignment = topic_assignments[0][4:]
-
-        if not self.organization.configuration:
-            return False
-        if "repositories" not in self.organization.configuration:
-            # Convert from the old style configuration to the current version
-            settings = copy(self.organization.configuration)
-            settings["merges"] = {}
-            settings["features"] = {}
-            if "labels" in settings:
-                del settings["labels"]
-            for feature in ["has_issues", "has_wiki", "has_downloads", "has_projects"]:
-                if feature in settings:
-                    settings["features"][feature] = settings[feature]
-                    del settings[feature]
-            for merge in [
-                "allow_rebase_merge",
-                "allow_squash_merge",
-                "allow_merge_commit",
-            ]:
-                if merge in settings:
-                    settings["merges"][merge] = settings[merge]
-                    del settings[merge]
-            return settings
-        if name and name in self.organization.configuration["repositories"]:
-            settings = self.organization.configuration["repositories"][name]
-        elif (
-            topic_assignment
-            and topic_assignment in self.organization.configuration["repositories"]
-        ):
-            settings = self.organization.configuration["repositories"][topic_assignment]
-        elif not name and self.name in self.organization.configuration["repositories"]:
-            settings = self.organization.configuration["repositories"][self.name]
-        elif "default" in self.organization.configuration["repositories"]:
-            settings = self.organization.configuration["repositories"]["default"]
-        if not settings:
-            return False
-
-        if isinstance(settings, str):
-            settings = {"extends": settings}
-
-        if "extends" in settings and maxdepth > 0:
-            parent = self.get_organizer_settings(
-                name=settings["extends"], maxdepth=maxdepth - 1
-            )
-            if parent:
-                parent.update(settings)
-                settings = parent
-            del settings["extends"]
-
-        self._settings = settings
-        return settings
+        topics = []
+        if self.organization.configuration.topics_for_assignment:
+            # Listings already include the topics, which saves a request per repository
+            topics = self.repository._rawData.get("topics")
+            if topics is None:
+                topics = self.get_topics()
+        self._settings = self.organization.get_profile(self.name, topics)
+        return self._settings
 
     def update_labels(self):
         """Update labels for a repository"""
         current_labels = self.get_labels()  # [x.name for x in self.ghrep.labels()]
 
         # Remove any labels not in the configuration
-        if self.organization.configuration.get("labels_clean", False):
-            label_names = [
-                x["name"] for x in self.organization.configuration.get("labels", [])
-            ]
-            for active_label in self.repository.get_labels():
+        if self.organization.configuration.labels_clean:
+            config_labels = self.organization.configuration.labels
+            # Labels about to be renamed are kept as well
+            label_names = [x.name for x in config_labels]
+            label_names += [x.old_name for x in config_labels if x.old_name]
+            for active_label in current_labels.values():
                 if active_label.name not in label_names:
-                    active_label.delete()
+                    with phase("write"):
+                        active_label.delete()
 
-        for config_label in self.organization.configuration.get("labels", []):
-            if config_label.get("old_name"):
-                label_object = self.repository.get_label(config_label["old_name"])
+        for config_label in self.organization.configuration.labels:
+            description = (
+                NotSet if config_label.description is None else config_label.description
+            )
+            if config_label.old_name:
+                # A missing label is looked up in the listing, get_label raises
+                label_object = current_labels.get(config_label.old_name)
                 if label_object:
-                    label_object.edit(
-                        config_label["name"],
-                        config_label.get("color", DEFAULT_LABEL_COLOR),
-                        config_label.get("description", NotSet),
-                    )
+                    with phase("write"):
+                        label_object.edit(
+                            config_label.name, config_label.color, description
+                        )
                     continue
 
-            if config_label["name"] in current_labels:
+            if config_label.name in current_labels:
                 label_object = current_labels[
-                    config_label["name"]
+                    config_label.name
                 ]  # self.ghrep.label(config_label['name'])
                 if not label_matches(config_label, label_object):
-                    label_object.edit(
-                        config_label["name"],
-                        config_label.get("color", DEFAULT_LABEL_COLOR),
-                        config_label.get("description", None),
-                    )
+                    with phase("write"):
+                        label_object.edit(
+                            config_label.name, config_label.color, description
+                        )
             else:
-                self.repository.create_label(
-                    config_label["name"],
-                    config_label.get("color", DEFAULT_LABEL_COLOR),
-                    config_label.get("description", NotSet),
-                )
+                with phase("write"):
+                    self.repository.create_label(
+                        config_label.name, config_label.color, description
+                    )
 
     # def update_issues(self):
     #     organizer_settings = self.get_organizer_settings()
@@ -352,15 +628,46 @@ class OrganizerRepository:
     #     for issue in self.ghrep.issues(state="open", sort="created", direction="asc"):
     #         project_column.create_card_with_issue(issue)
 
-    def update_security_scanning(self) -> None:
-        """Update Security Scanning settings for a repository"""
+    def get_security_settings(self) -> dict:
+        """Get the configured dependency security settings for a repository"""
         organizer_settings = self.get_organizer_settings()
-        if organizer_settings and "dependency_security" not in organizer_settings:
-            sec = organizer_settings["dependency_security"]
-            if "alerts" in sec:
-                self.toggle_vulnerability_alerts(sec["alerts"])
-            if "automatic_fixes" in sec:
-                self.toggle_security_fixes(sec["automatic_fixes"])
+        if not organizer_settings:
+            return {}
+        return dict(organizer_settings.dependency_security or {})
+
+    def get_security_fixes_enabled(self):
+        """Get the automated security fix state, preferring the listing data"""
+        analysis = self.repository._rawData.get("security_and_analysis") or {}
+        if "dependabot_security_updates" in analysis:
+            return analysis["dependabot_security_updates"].get("status") == "enabled"
+        try:
+            _, data = self.repository._requester.requestJsonAndCheck(
+                "GET", f"{self.repository.url}/automated-security-fixes"
+            )
+            return data.get("enabled", False)
+        except UnknownObjectException:
+            return False
+
+    def get_security_state(self, setting: str) -> bool:
+        """Get the current state of a dependency security setting"""
+        if setting == "alerts":
+            return self.repository.get_vulnerability_alert()
+        return self.get_security_fixes_enabled()
+
+    def update_security_scanning(self, current: dict = None) -> None:
+        """Update Security Scanning settings for a repository"""
+        # States already known (e.g. from a bulk read) save a request per setting
+        current = current or {}
+        for setting, enable in self.get_security_settings().items():
+            state = current.get(setting)
+            if state is None:
+                state = self.get_security_state(setting)
+            if state == enable:
+                continue
+            if setting == "alerts":
+                self.toggle_vulnerability_alerts(enable)
+            else:
+                self.toggle_security_fixes(enable)
 
     def toggle_vulnerability_alerts(self, enable):
         """Update Vulnerability Alert settings for a repository"""
@@ -451,49 +758,10 @@ class OrganizerRepository:
             branch_name, current_default_branch.latest_sha()
         )
 
-    def branch_protection(
-        self,
-        branch: Branch,
-        required_status_checks=None,
-        enforce_admins: bool = True,
-        require_review: bool = True,
-        restrictions=None,
-        required_linear_history: bool = NotSet,
-        allow_force_pushes: bool = NotSet,
-        required_approving_review_count: int = NotSet,
-        require_code_owner_reviews: bool = NotSet,
-        dismiss_stale_reviews: bool = NotSet,
-        dismissal_restrictions=NotSet,
-        bypass_restrictions=NotSet,
-        lock_branch: bool = NotSet,
-        allow_fork_syncing: bool = NotSet,
-        block_creations: bool = NotSet,
-        required_conversation_resolution: bool = NotSet,
-        # allow_deletions: bool = False,
-    ):
+    def branch_protection(self, branch: Branch, policy: BranchPolicy):
         """Update Branch Protection settings for a repository"""
-        # required_status_checks
-        # - strict - boolean
-        # - contexts - array, leave empty for "all"
-        if required_status_checks:
-            if "contexts" not in required_status_checks:
-                required_status_checks["contexts"] = []
-            if "strict" not in required_status_checks:
-                required_status_checks["strict"] = False
-
-        # enforce_admins - boolean
-        enforce_admins = bool(enforce_admins)
-
-        # required_pull_request_reviews
-        # - dismissal_restrictions - object (optional)
-        #   - users - array
-        #   - teams - array
-        # - dismiss_stale_reviews - boolean
-        # - require_code_owner_reviews - boolean
-        # - required_approving_review_count - integer
-        if not require_review and not required_status_checks.get(
-            "require_review", False
-        ):
+        # required_pull_request_reviews defaults to on, turning it off drops the protection
+        if policy.require_review is False:
             try:
                 branch.remove_protection()
             except GithubException as exception:
@@ -502,61 +770,48 @@ class OrganizerRepository:
                 )
             return
 
-        # dismissal_restrictions
-        # - users - array
-        # - teams - array
-        # - apps - array
-        if dismissal_restrictions:
-            for field in ["users", "teams", "apps"]:
-                if field not in dismissal_restrictions:
-                    dismissal_restrictions[field] = []
-        # bypass_restrictions
-        # - users - array
-        # - teams - array
-        # - apps - array
-        if bypass_restrictions:
-            for field in ["users", "teams", "apps"]:
-                if field not in bypass_restrictions:
-                    bypass_restrictions[field] = []
-        # restrictions
+        # required_status_checks
+        # - strict - boolean
+        # - contexts - array, leave empty for "all"
+        checks = policy.required_status_checks
+        # restrictions, dismissal_restrictions and bypass_restrictions
         # - users - array
         # - teams - array
         # - apps - array
-        if restrictions:
-            for field in ["users", "teams", "apps"]:
-                if field not in restrictions:
-                    restrictions[field] = []
+        restrictions = actors_or_notset(policy.restrictions)
+        dismissal_restrictions = actors_or_notset(policy.dismissal_restrictions)
+        bypass_restrictions = actors_or_notset(policy.bypass_restrictions)
         try:
-            branch.edit_protection(
-                strict=required_status_checks.get("strict", NotSet),
-                contexts=required_status_checks.get("contexts", NotSet),
-                enforce_admins=enforce_admins,
-                user_push_restrictions=restrictions.get("users", NotSet),
-                team_push_restrictions=restrictions.get("teams", NotSet),
-                app_push_restrictions=restrictions.get("apps", NotSet),
-                dismissal_users=dismissal_restrictions.get("users", NotSet),
-                dismissal_teams=dismissal_restrictions.get("teams", NotSet),
-                dismissal_apps=dismissal_restrictions.get("apps", NotSet),
-                users_bypass_pull_request_allowances=bypass_restrictions.get(
-                    "users", NotSet
-                ),
-                teams_bypass_pull_request_allowances=bypass_restrictions.get(
-                    "teams", NotSet
-                ),
-                apps_bypass_pull_request_allowances=bypass_restrictions.get(
-                    "apps", NotSet
-                ),
-                dismiss_stale_reviews=dismiss_stale_reviews,
-                require_code_owner_reviews=require_code_owner_reviews,
-                required_approving_review_count=required_approving_review_count,
-                required_linear_history=required_linear_history,
-                allow_force_pushes=allow_force_pushes,
-                lock_branch=lock_branch,
-                allow_fork_syncing=allow_fork_syncing,
-                block_creations=block_creations,
-                required_conversation_resolution=required_conversation_resolution
-                # allow_deletions = allow_deletions
-            )
+            with phase("write"):
+                branch.edit_protection(
+                    strict=bool(checks.strict) if checks else NotSet,
+                    contexts=list(checks.contexts or []) if checks else NotSet,
+                    enforce_admins=value_or(policy.enforce_admins, True),
+                    user_push_restrictions=restrictions["users"],
+                    team_push_restrictions=restrictions["teams"],
+                    app_push_restrictions=restrictions["apps"],
+                    dismissal_users=dismissal_restrictions["users"],
+                    dismissal_teams=dismissal_restrictions["teams"],
+                    dismissal_apps=dismissal_restrictions["apps"],
+                    users_bypass_pull_request_allowances=bypass_restrictions["users"],
+                    teams_bypass_pull_request_allowances=bypass_restrictions["teams"],
+                    apps_bypass_pull_request_allowances=bypass_restrictions["apps"],
+                    dismiss_stale_reviews=value_or(policy.dismiss_stale_reviews),
+                    require_code_owner_reviews=value_or(
+                        policy.require_code_owner_reviews
+                    ),
+                    required_approving_review_count=value_or(
+                        policy.required_approving_review_count, 1
+                    ),
+                    required_linear_history=value_or(policy.required_linear_history),
+                    allow_force_pushes=value_or(policy.allow_force_pushes),
+                    lock_branch=value_or(policy.lock_branch),
+                    allow_fork_syncing=value_or(policy.allow_fork_syncing),
+                    block_creations=value_or(policy.block_creations),
+                    required_conversation_resolution=value_or(
+                        policy.required_conversation_resolution
+                    ),
+                )
         except GithubException as exception:
             print(
                 f"Error updating branch protections for {branch.name}: {exception.message}"
@@ -597,10 +852,61 @@ class OrganizerRepository:
 #         return self.get_column(id)
 
 
-def label_matches(config_label, label):
+def get_record_data(node: dict) -> dict:
+    """Flatten a repository records node into the keys of the REST API"""
+    branch = node.pop("defaultBranchRef", None) or {}
+    topics = node.pop("repositoryTopics", None) or {}
+    rulesets = node.pop("rulesets", None) or {}
+    data = {x: node[x] for x in node if node[x] is not None}
+    data["topics"] = [x["topic"]["name"] for x in topics.get("nodes") or []]
+    # Empty repositories have no default branch to protect yet
+    if branch:
+        data["default_branch"] = branch["name"]
+        # Organization rulesets protect a branch as well as classic protection
+        data["protected"] = bool(branch.get("branchProtectionRule")) or any(
+            ruleset_covers(x, branch["name"]) for x in rulesets.get("nodes") or []
+        )
+    return data
+
+
+def ruleset_covers(ruleset: dict, branch: str, default: bool = True) -> bool:
+    """Check if an active branch ruleset applies to a branch, by default the default"""
+    if (
+        not branch
+        or ruleset["enforcement"] != "ACTIVE"
+        or ruleset["target"] != "BRANCH"
+    ):
+        return False
+    ref_name = (ruleset.get("conditions") or {}).get("refName") or {}
+    ref = f"refs/heads/{branch}"
+    if any(ref_matches(x, ref, default) for x in ref_name.get("exclude") or []):
+        return False
+    return any(ref_matches(x, ref, default) for x in ref_name.get("include") or [])
+
+
+def ref_matches(pattern: str, ref: str, default: bool = True) -> bool:
+    """Check a ruleset ref pattern against the ref of a branch"""
+    if pattern == "~DEFAULT_BRANCH":
+        return default
+    return pattern == "~ALL" or fnmatch.fnmatchcase(ref, pattern)
+
+
+def label_matches(config_label: LabelConfig, label):
     """Check if a label matches the config"""
-    if label.color != config_label.get("color", DEFAULT_LABEL_COLOR):
+    if label.color != config_label.color:
         return False
-    if label.description != config_label.get("description", None):
+    if label.description != config_label.description:
         return False
     return True
+
+
+def value_or(value, default=NotSet):
+    """Get a configured value, falling back to a default when it is unset"""
+    return default if value is None else value
+
+
+def actors_or_notset(actors) -> dict:
+    """Get the users, teams and apps of a restriction, or NotSet when unset"""
+    if not actors:
+        return {"users": NotSet, "teams": NotSet, "apps": NotSet}
+    return actors.as_dict()
@@ -0,0 +1,124 @@
+"""Sampling profiler and phase timers for diagnosing slow runs"""
+import functools
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Wall clock sampling, so time spent waiting on the API shows up as well
+SAMPLE_INTERVAL = 0.005
+PROFILER = None
+
+
+class Profiler:
+    """Samples the stacks of every thread and times the phases of a run"""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        """Initialize Class"""
+        self.interval = interval
+        self.stacks = {}
+        self.phases = {}
+        # The phases each thread is in, so samples can be grouped by phase
+        self.active = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.started = None
+        self.elapsed = None
+
+    def start(self):
+        """Start sampling and make the phase timers record into this profiler"""
+        global PROFILER  # pylint: disable=global-statement
+        PROFILER = self
+        self.started = time.perf_counter()
+        self.thread.start()
+
+    def stop(self):
+        """Stop sampling and the phase timers"""
+        global PROFILER  # pylint: disable=global-statement
+        PROFILER = None
+        self.stopped.set()
+        self.thread.join()
+        self.elapsed = time.perf_counter() - self.started
+
+    def sample(self):
+        """Count the current stack of every other thread until stopped"""
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    filename = os.path.basename(code.co_filename)
+                    stack.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                phases = [f"[{x}]" for x in self.active.get(thread_id, ())]
+                key = ";".join(phases + stack[::-1])
+                with self.lock:
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def record(self, name: str, seconds: float):
+        """Add a finished phase to the timers"""
+        with self.lock:
+            calls, total = self.phases.get(name, (0, 0))
+            self.phases[name] = (calls + 1, total + seconds)
+
+    def write_stacks(self, path: str):
+        """Write the samples as collapsed stacks for flamegraph.pl or speedscope"""
+        with open(path, "w", encoding="utf-8") as file:
+            for stack, count in sorted(self.stacks.items()):
+                file.write(f"{stack} {count}\n")
+
+    def get_summary(self) -> str:
+        """Format the phase timers as a table"""
+        # Threads run phases concurrently, so they can add up to more than wall
+        lines = [
+            f"{'phase':<16}{'calls':>8}{'seconds':>12}{'mean ms':>12}{'% wall':>8}",
+        ]
+        for name, (calls, total) in sorted(
+            self.phases.items(), key=lambda x: x[1][1], reverse=True
+        ):
+            lines.append(
+                f"{name:<16}{calls:>8}{total:>12.3f}{total / calls * 1000:>12.2f}"
+                f"{total / self.elapsed * 100:>8.1f}"
+            )
+        lines.append(f"{'wall':<16}{'':>8}{self.elapsed:>12.3f}")
+        lines.append(f"{sum(self.stacks.values())} samples")
+        return "\n".join(lines)
+
+
+@contextmanager
+def phase(name: str):
+    """Time a block as a phase of the run, when profiling"""
+    profiler = PROFILER
+    if profiler is None:
+        yield
+        return
+    thread_id = threading.get_ident()
+    active = profiler.active.setdefault(thread_id, [])
+    active.append(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profiler.record(name, time.perf_counter() - started)
+        active.pop()
+
+
+def timed(name: str):
+    """Decorator to time every call of a function as a phase of the run"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if PROFILER is None:
+                return function(*args, **kwargs)
+            with phase(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
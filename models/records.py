@@ -0,0 +1,112 @@
+"""Compact repository records for the streaming sync pipeline"""
+from github import Repository
+
+from models.profiling import timed
+from models.schema import FEATURE_KEYS, MERGE_KEYS, RepositoryProfile
+
+# The repository flags the organizer compares, in the order they are stored
+SETTING_KEYS = tuple(FEATURE_KEYS) + tuple(MERGE_KEYS)
+SETTING_INDEX = {key: index for index, key in enumerate(SETTING_KEYS)}
+
+
+class RepositoryRecord:
+    """The fields of a repository the organizer compares, without the API object"""
+
+    __slots__ = (
+        "name",
+        "node_id",
+        "fork",
+        "archived",
+        "default_branch",
+        "topics",
+        "created_at",
+        "protected",
+        "settings",
+        "profile",
+    )
+
+    def __repr__(self):
+        return "RepositoryRecord %s" % self.name
+
+    def __init__(self, data: dict, profile: RepositoryProfile = None):
+        """Initialize Class from the raw API data of a repository"""
+        self.name = data["name"]
+        self.node_id = data.get("node_id")
+        self.fork = data.get("fork", False)
+        self.archived = data.get("archived", False)
+        self.default_branch = data.get("default_branch")
+        self.topics = tuple(data.get("topics") or ())
+        self.created_at = data.get("created_at")
+        # Whether the default branch is protected, None when it was not read
+        self.protected = data.get("protected")
+        # Settings missing from the listing are None, which is not a change
+        self.settings = tuple(data.get(key) for key in SETTING_KEYS)
+        # Shared by reference with every other repository using the profile
+        self.profile = profile
+
+    @classmethod
+    def from_repository(cls, org, repository: Repository, details: dict = None):
+        """Create a record for a listed repository and resolve its profile"""
+        # Data read in bulk elsewhere, like the merge settings, fills in the listing
+        return cls.from_data(org, {**repository._rawData, **(details or {})})
+
+    @classmethod
+    def from_data(cls, org, data: dict):
+        """Create a record from the API data of a repository and resolve its profile"""
+        record = cls(data)
+        record.profile = org.get_profile(record.name, record.topics)
+        return record
+
+    def get_setting(self, key: str):
+        """Get the current value of a repository flag, None when unknown"""
+        return self.settings[SETTING_INDEX[key]]
+
+    def update_settings(self, data: dict):
+        """Fill in unknown repository flags from the full API data"""
+        self.settings = tuple(
+            data.get(key) if value is None else value
+            for key, value in zip(SETTING_KEYS, self.settings)
+        )
+
+    def get_wanted_settings(self) -> dict:
+        """Get the repository flags set by the profile"""
+        if not self.profile:
+            return {}
+        wanted = dict(self.profile.features or {})
+        # has_downloads is deprecated and not accepted by the API anymore
+        wanted.pop("has_downloads", None)
+        wanted.update(self.profile.merges or {})
+        return wanted
+
+    def get_unknown_settings(self) -> list:
+        """Get the flags set by the profile that the record has no value for"""
+        return [x for x in self.get_wanted_settings() if self.get_setting(x) is None]
+
+    def get_default_branch_policy(self) -> tuple:
+        """Get the default branch after a sync and its policy, None if unprotected"""
+        branches = (self.profile and self.profile.branches) or {}
+        branch = self.default_branch
+        if not self.fork:
+            branch = next((x for x in branches if branches[x].default), branch)
+        policy = branches.get(branch)
+        if policy is None or policy.require_review is False:
+            return branch, None
+        return branch, policy
+
+    @timed("diff")
+    def get_changes(self) -> dict:
+        """Get the repository flags that differ from the profile"""
+        if not self.profile:
+            return {}
+        changes = {
+            key: value
+            for key, value in self.get_wanted_settings().items()
+            if self.get_setting(key) not in (None, value)
+        }
+        # Forks keep the default branch of their upstream
+        if not self.fork:
+            for branch, policy in (self.profile.branches or {}).items():
+                if policy.default and self.default_branch != branch:
+                    changes["default_branch"] = branch
+                    break
+        return changes
@@ -0,0 +1,354 @@
+"""Schema and compiled objects for the organizer configuration"""
+import re
+
+DEFAULT_LABEL_COLOR = "000000"
+LABEL_COLOR_PATTERN = re.compile(r"^[0-9a-fA-F]{6}$")
+
+
+class ConfigurationError(Exception):
+    """Raised when organizer.yaml does not match the schema"""
+
+    def __init__(self, errors: list):
+        super().__init__("\n".join(errors))
+        self.errors = errors
+
+
+class Mapping:
+    """Schema for a dictionary with free-form string keys"""
+
+    def __init__(self, spec):
+        self.spec = spec
+
+
+class LabelColor:
+    """Schema for a six digit hexadecimal label color"""
+
+
+FEATURE_KEYS = {
+    "has_issues": bool,
+    "has_projects": bool,
+    "has_wiki": bool,
+    "has_downloads": bool,
+    "allow_forking": bool,
+    "web_commit_signoff_required": bool,
+}
+MERGE_KEYS = {
+    "allow_squash_merge": bool,
+    "allow_merge_commit": bool,
+    "allow_rebase_merge": bool,
+    "allow_auto_merge": bool,
+    "delete_branch_on_merge": bool,
+    "allow_update_branch": bool,
+    "use_squash_pr_title_as_default": bool,
+    "squash_merge_commit_title": ("PR_TITLE", "COMMIT_OR_PR_TITLE"),
+    "squash_merge_commit_message": ("PR_BODY", "COMMIT_MESSAGES", "BLANK"),
+    "merge_commit_title": ("PR_TITLE", "MERGE_MESSAGE"),
+    "merge_commit_message": ("PR_BODY", "PR_TITLE", "BLANK"),
+}
+SECURITY_KEYS = {"alerts": bool, "automatic_fixes": bool}
+STATUS_CHECK_KEYS = {"strict": bool, "contexts": [str]}
+ACTOR_KEYS = {"users": [str], "teams": [str], "apps": [str]}
+BRANCH_KEYS = {
+    "default": bool,
+    "required_status_checks": STATUS_CHECK_KEYS,
+    "enforce_admins": bool,
+    "require_review": bool,
+    "restrictions": ACTOR_KEYS,
+    "required_linear_history": bool,
+    "allow_force_pushes": bool,
+    "required_approving_review_count": int,
+    "require_code_owner_reviews": bool,
+    "dismiss_stale_reviews": bool,
+    "dismissal_restrictions": ACTOR_KEYS,
+    "bypass_restrictions": ACTOR_KEYS,
+    "lock_branch": bool,
+    "allow_fork_syncing": bool,
+    "block_creations": bool,
+    "required_conversation_resolution": bool,
+}
+PROFILE_KEYS = {
+    "extends": str,
+    "features": FEATURE_KEYS,
+    "merges": MERGE_KEYS,
+    "branches": Mapping(BRANCH_KEYS),
+    "dependency_security": SECURITY_KEYS,
+}
+PERMISSIONS = ("pull", "triage", "push", "maintain", "admin")
+TEAM_KEYS = {
+    "repositories": Mapping(PERMISSIONS),
+    "profiles": Mapping(PERMISSIONS),
+    "clean": bool,
+}
+LABEL_KEYS = {
+    "name": str,
+    "color": LabelColor,
+    "description": str,
+    "old_name": str,
+}
+ORGANIZATION_KEYS = {
+    # Profiles are checked separately as they may be an `extends` shorthand
+    "repositories": dict,
+    "labels": [LABEL_KEYS],
+    "labels_clean": bool,
+    "exclude_repositories": [str],
+    "exclude_forks": bool,
+    "exclude_archived": bool,
+    "topics_for_assignment": bool,
+    "teams": Mapping(TEAM_KEYS),
+}
+
+TYPE_NAMES = {bool: "a boolean", int: "an integer", str: "a string", dict: "a mapping"}
+
+
+def check_value(value, spec, path: str, errors: list):
+    """Check a value against a schema spec, appending any problems to errors"""
+    if value is None:
+        # Empty keys are treated as not set
+        return
+    if isinstance(spec, dict):
+        if not isinstance(value, dict):
+            errors.append(f"{path}: expected a mapping")
+            return
+        for key, item in value.items():
+            if key not in spec:
+                errors.append(f"{path}.{key}: unknown key")
+            else:
+                check_value(item, spec[key], f"{path}.{key}", errors)
+    elif isinstance(spec, Mapping):
+        if not isinstance(value, dict):
+            errors.append(f"{path}: expected a mapping")
+            return
+        for key, item in value.items():
+            if not isinstance(key, str):
+                errors.append(f"{path}.{key}: key must be a string")
+            check_value(item, spec.spec, f"{path}.{key}", errors)
+    elif isinstance(spec, list):
+        if not isinstance(value, list):
+            errors.append(f"{path}: expected a list")
+            return
+        for index, item in enumerate(value):
+            check_value(item, spec[0], f"{path}[{index}]", errors)
+    elif isinstance(spec, tuple):
+        if value not in spec:
+            errors.append(f"{path}: expected one of {', '.join(spec)}")
+    elif spec is LabelColor:
+        if not isinstance(value, str) or not LABEL_COLOR_PATTERN.match(value):
+            errors.append(f"{path}: expected a quoted six digit hex color")
+    elif not isinstance(value, spec) or (spec is int and isinstance(value, bool)):
+        errors.append(f"{path}: expected {TYPE_NAMES[spec]}")
+
+
+def validate_configuration(config: dict) -> list:
+    """Validate a parsed configuration, returning a list of errors"""
+    errors = []
+    if not isinstance(config, dict):
+        return ["organizer.yaml: expected a mapping"]
+    check_value(config, ORGANIZATION_KEYS, "organizer", errors)
+    profiles = config.get("repositories") or {}
+    if not isinstance(profiles, dict):
+        return errors
+    for name, profile in profiles.items():
+        path = f"organizer.repositories.{name}"
+        if isinstance(profile, str):
+            profile = {"extends": profile}
+        check_value(profile, PROFILE_KEYS, path, errors)
+        if not isinstance(profile, dict):
+            continue
+        # Values of the wrong type were reported by check_value and are skipped here
+        extends = profile.get("extends")
+        if isinstance(extends, str) and extends not in profiles:
+            errors.append(f"{path}.extends: unknown profile {extends}")
+        branches = profile.get("branches") or {}
+        if isinstance(branches, dict):
+            defaults = [
+                x
+                for x in branches
+                if isinstance(branches[x], dict) and branches[x].get("default")
+            ]
+            if len(defaults) > 1:
+                errors.append(f"{path}.branches: more than one default branch")
+        if get_extends_chain(profiles, name) is None:
+            errors.append(f"{path}.extends: circular extends")
+    teams = config.get("teams") or {}
+    if isinstance(teams, dict):
+        for slug, team in teams.items():
+            team_profiles = team.get("profiles") if isinstance(team, dict) else None
+            if not isinstance(team_profiles, dict):
+                continue
+            for profile in team_profiles:
+                if profile not in profiles:
+                    errors.append(
+                        f"organizer.teams.{slug}.profiles.{profile}: unknown profile"
+                    )
+    labels = config.get("labels") or []
+    if isinstance(labels, list):
+        names = set()
+        for index, label in enumerate(labels):
+            if not isinstance(label, dict):
+                continue
+            if not label.get("name"):
+                errors.append(f"organizer.labels[{index}].name: required")
+            elif not isinstance(label["name"], str):
+                continue
+            elif label["name"] in names:
+                errors.append(f"organizer.labels[{index}].name: duplicate label")
+            names.add(label.get("name"))
+    return errors
+
+
+def get_extends_chain(profiles: dict, name: str):
+    """Get the profile names a profile extends, or None if they form a cycle"""
+    chain = []
+    while name is not None:
+        if name in chain:
+            return None
+        chain.append(name)
+        profile = profiles.get(name)
+        if isinstance(profile, str):
+            name = profile
+        elif isinstance(profile, dict) and isinstance(profile.get("extends"), str):
+            name = profile["extends"]
+        else:
+            name = None
+    return chain
+
+
+class ConfigObject:
+    """Base class for the compiled configuration objects"""
+
+    __slots__ = ()
+    children = {}
+    defaults = {}
+
+    def __init__(self, data: dict):
+        for key in self.__slots__:
+            value = data.get(key)
+            if value is not None and key in self.children:
+                value = self.children[key](value)
+            if value is None:
+                value = self.defaults.get(key)
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return "%s %s" % (self.__class__.__name__, self.to_dict())
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+    def __hash__(self):
+        return hash(repr(self))
+
+    def to_dict(self) -> dict:
+        """Convert back to the organizer.yaml layout, leaving out unset keys"""
+        data = {}
+        for key in self.__slots__:
+            value = getattr(self, key)
+            if value is not None:
+                data[key] = to_plain(value)
+        return data
+
+
+def to_plain(value):
+    """Convert compiled objects back into plain YAML/JSON values"""
+    if isinstance(value, ConfigObject):
+        return value.to_dict()
+    if isinstance(value, dict):
+        return {key: to_plain(item) for key, item in value.items()}
+    if isinstance(value, frozenset):
+        return sorted(value)
+    if isinstance(value, (list, tuple)):
+        return [to_plain(item) for item in value]
+    return value
+
+
+class ActorList(ConfigObject):
+    """Users, teams and apps for a branch protection restriction"""
+
+    __slots__ = tuple(ACTOR_KEYS)
+
+    def as_dict(self) -> dict:
+        """Get every actor field, with empty lists for unset fields"""
+        return {key: list(getattr(self, key) or []) for key in self.__slots__}
+
+
+class StatusChecks(ConfigObject):
+    """Required status checks for a protected branch"""
+
+    __slots__ = tuple(STATUS_CHECK_KEYS)
+
+
+class BranchPolicy(ConfigObject):
+    """Protection and default settings for a single branch"""
+
+    __slots__ = tuple(BRANCH_KEYS)
+    children = {
+        "required_status_checks": StatusChecks,
+        "restrictions": ActorList,
+        "dismissal_restrictions": ActorList,
+        "bypass_restrictions": ActorList,
+    }
+
+
+def compile_branches(branches: dict) -> dict:
+    """Compile the branch policies of a profile"""
+    return {name: BranchPolicy(policy or {}) for name, policy in branches.items()}
+
+
+def compile_settings(settings: dict) -> dict:
+    """Drop the unset keys of a settings group"""
+    return {key: value for key, value in settings.items() if value is not None}
+
+
+class RepositoryProfile(ConfigObject):
+    """A flattened repository settings profile"""
+
+    __slots__ = ("features", "merges", "branches", "dependency_security")
+    children = {
+        "features": compile_settings,
+        "merges": compile_settings,
+        "branches": compile_branches,
+        "dependency_security": compile_settings,
+    }
+
+
+class LabelConfig(ConfigObject):
+    """A label that should exist in every repository"""
+
+    __slots__ = tuple(LABEL_KEYS)
+    # GitHub reports colors in lowercase, so compare them that way
+    children = {"color": str.lower}
+    defaults = {"color": DEFAULT_LABEL_COLOR}
+
+
+class TeamConfig(ConfigObject):
+    """The repository permissions granted to a team"""
+
+    __slots__ = tuple(TEAM_KEYS)
+    defaults = {"repositories": {}, "profiles": {}, "clean": False}
+
+
+def compile_profiles(profiles: dict) -> dict:
+    """Compile flattened repository profiles"""
+    return {
+        name: RepositoryProfile(profile) if profile else None
+        for name, profile in profiles.items()
+    }
+
+
+class OrganizerConfig(ConfigObject):
+    """The compiled configuration of an organization"""
+
+    __slots__ = tuple(ORGANIZATION_KEYS)
+    children = {
+        "repositories": compile_profiles,
+        "labels": lambda labels: tuple(LabelConfig(x) for x in labels),
+        "exclude_repositories": frozenset,
+        "teams": lambda teams: {x: TeamConfig(teams[x] or {}) for x in teams},
+    }
+    defaults = {
+        "repositories": {},
+        "labels": (),
+        "exclude_repositories": frozenset(),
+        "topics_for_assignment": True,
+        "teams": {},
+    }
@@ -0,0 +1,178 @@
+"""Offline snapshots of an organization for planning and audits without the API"""
+import json
+import sqlite3
+import time
+
+from models import gh
+from models.gh import (
+    LABEL_FIELDS,
+    REPOSITORY_NODES_QUERY,
+    RULESET_FIELDS,
+    OrganizerOrganization,
+    get_listing_pages,
+)
+from models.records import SETTING_KEYS
+from models.schema import OrganizerConfig
+
+SNAPSHOT_VERSION = 3
+# Lets SQLite read the snapshot through a memory map instead of copying pages
+SNAPSHOT_MMAP_SIZE = 256 * 1024 * 1024
+LISTING_KEYS = (
+    ("name", "node_id", "fork", "archived", "default_branch", "topics")
+    + SETTING_KEYS
+    + ("security_and_analysis",)
+)
+
+SNAPSHOT_QUERY = REPOSITORY_NODES_QUERY % (
+    LABEL_FIELDS
+    + """
+hasVulnerabilityAlertsEnabled
+branchProtectionRules(first: 20) {
+  nodes {
+    pattern
+    isAdminEnforced
+    requiresApprovingReviews
+    requiredApprovingReviewCount
+    dismissesStaleReviews
+    requiresCodeOwnerReviews
+    requiresStatusChecks
+    requiresStrictStatusChecks
+    requiredStatusCheckContexts
+    requiresLinearHistory
+    allowsForcePushes
+    requiresConversationResolution
+    lockBranch
+    blocksCreations
+  }
+}
+"""
+    + RULESET_FIELDS
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS repositories (
+    name TEXT PRIMARY KEY,
+    listing TEXT NOT NULL,
+    details TEXT
+) WITHOUT ROWID;
+"""
+
+
+class SnapshotError(Exception):
+    """Raised when a snapshot file can't be used"""
+
+
+def write_snapshot(org: OrganizerOrganization, path: str) -> sqlite3.Connection:
+    """Write the relevant state of every repository of an organization"""
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    connection.execute("DELETE FROM repositories")
+    meta = {
+        "version": SNAPSHOT_VERSION,
+        "login": org.login,
+        "name": org.name,
+        "created": int(time.time()),
+        "configuration": org.configuration.to_dict(),
+    }
+    connection.executemany(
+        "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+        [(key, json.dumps(value)) for key, value in meta.items()],
+    )
+    # The listing has most repository flags, GraphQL the merge settings, labels
+    # and protection
+    for listing in get_listing_pages(org.org):
+        nodes = org.get_repository_records([x.node_id for x in listing])
+        details = {x["node_id"]: x for x in nodes}
+        connection.executemany(
+            "INSERT OR REPLACE INTO repositories (name, listing) VALUES (?, ?)",
+            [
+                (x.name, json.dumps(get_listing(x._rawData, details.get(x.node_id))))
+                for x in listing
+            ],
+        )
+    for node in org.get_repository_labels(SNAPSHOT_QUERY):
+        node["branchProtectionRules"] = node["branchProtectionRules"]["nodes"]
+        node["rulesets"] = node["rulesets"]["nodes"]
+        connection.execute(
+            "UPDATE repositories SET details = ? WHERE name = ?",
+            (json.dumps(node), node["name"]),
+        )
+    connection.commit()
+    return connection
+
+
+def get_listing(data: dict, details: dict = None) -> dict:
+    """Get the stored listing of a repository, with the flags read in bulk"""
+    details = details or {}
+    return {key: details.get(key, data.get(key)) for key in LISTING_KEYS}
+
+
+class Snapshot:
+    """Read access to a snapshot file, indexed by repository name"""
+
+    def __init__(self, path_or_connection):
+        """Initialize Class"""
+        if not isinstance(path_or_connection, sqlite3.Connection):
+            try:
+                self.connection = sqlite3.connect(
+                    f"file:{path_or_connection}?mode=ro", uri=True
+                )
+                self.connection.execute(f"PRAGMA mmap_size={SNAPSHOT_MMAP_SIZE}")
+                rows = self.connection.execute("SELECT key, value FROM meta").fetchall()
+            except sqlite3.Error as exception:
+                raise SnapshotError(
+                    f"{path_or_connection} is not a snapshot: {exception}"
+                ) from exception
+        else:
+            self.connection = path_or_connection
+            rows = self.connection.execute("SELECT key, value FROM meta").fetchall()
+        self.meta = {key: json.loads(value) for key, value in rows}
+        if self.meta.get("version") != SNAPSHOT_VERSION:
+            raise SnapshotError(
+                f"Snapshot version {self.meta.get('version')} is not supported"
+            )
+
+    def get_repository(self, name: str):
+        """Get the listing and details of a single repository"""
+        row = self.connection.execute(
+            "SELECT listing, details FROM repositories WHERE name = ?", (name,)
+        ).fetchone()
+        return row and load_row(row)
+
+    def get_repositories(self):
+        """Yield the listing and details of every repository by name"""
+        cursor = self.connection.execute(
+            "SELECT listing, details FROM repositories ORDER BY name"
+        )
+        for row in cursor:
+            yield load_row(row)
+
+
+def load_row(row: tuple) -> tuple:
+    """Decode a stored repository row"""
+    listing, details = row
+    return json.loads(listing), json.loads(details) if details else None
+
+
+class SnapshotOrganization(OrganizerOrganization):
+    """An organization read from a snapshot, without any API access"""
+
+    def __init__(self, snapshot: Snapshot):
+        """Initialize Class"""
+        # pylint: disable=super-init-not-called
+        self.org = None
+        self.snapshot = snapshot
+        self.name = snapshot.meta["name"]
+        self.login = snapshot.meta["login"]
+        # A local --config takes precedence so config changes can be tried out
+        if gh.GLOBAL_CONFIG is not None:
+            self.configuration = gh.GLOBAL_CONFIG
+        else:
+            self.configuration = OrganizerConfig(snapshot.meta["configuration"])
+
+    def get_repository_labels(self, query: str = None):
+        """Yield every repository with its labels from the snapshot"""
+        for _, details in self.snapshot.get_repositories():
+            if details:
+                yield details
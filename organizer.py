@@ -2,50 +2,194 @@
 import click
 import yaml
 
-from models.gh import OrganizerOrganization, update_global_config
+from models.config import load_configuration
+from models.gh import (
+    OrganizerOrganization,
+    get_team_repository_permissions,
+    update_global_config,
+)
+from models.profiling import Profiler, phase
+from models.records import RepositoryRecord
+from models.schema import ConfigurationError
+from models.snapshot import (
+    Snapshot,
+    SnapshotError,
+    SnapshotOrganization,
+    write_snapshot,
+)
+from services.audit import audit_organization, plan_settings
 from services.github import gh
+from services.graphql import DEFAULT_BATCH_SIZE, update_organization_labels
+from services.pipeline import DEFAULT_WINDOW, DEFAULT_WORKERS, sync_organization
+from services.rulesets import update_organization_rulesets
+from services.scheduler import SyncBudget, SyncState
 from services.tasks import (
     update_org_repo_branch_protection,
+    update_organization_security_settings,
+    update_organization_teams,
     update_repo_branch_protection,
     update_repository_default_branch,
     update_repository_labels,
     update_repository_security_settings,
     update_repository_settings,
 )
+from services.workqueue import (
+    DEFAULT_LEASE_COUNT,
+    DEFAULT_LEASE_SECONDS,
+    QUEUE_TASKS,
+    QueueError,
+    WorkQueue,
+    fill_queue,
+    get_worker_id,
+    run_worker,
+)
+
 
+class OrganizerGroup(click.Group):
+    """Command group that reports configuration errors without a traceback"""
 
-@click.group()
+    def invoke(self, ctx):
+        try:
+            return super().invoke(ctx)
+        except ConfigurationError as exception:
+            raise click.ClickException(str(exception)) from exception
+
+
+@click.group(cls=OrganizerGroup)
 @click.option(
     "-c",
     "--config",
     type=click.Path(),
     help="Local configuration instead of organizational config",
 )
+@click.option(
+    "--profile",
+    type=click.Path(dir_okay=False),
+    help="Write collapsed stacks of the run here and print the phase timers",
+)
 @click.pass_context
-def cli(ctx, config):
+def cli(ctx, config, profile):
     """Primary intro to CLI"""
     if ctx.parent:
         print(ctx.parent.get_help())
+    if profile:
+        profiler = Profiler()
+        profiler.start()
+        ctx.call_on_close(lambda: report_profile(profiler, profile))
     if config:
-        with open(config, "r", encoding="utf-8") as file:
-            update_global_config(yaml.safe_load(file))
+        with open(config, "r", encoding="utf-8") as file, phase("config load"):
+            try:
+                update_global_config(load_configuration(file))
+            except ConfigurationError as exception:
+                raise click.ClickException(
+                    f"Invalid configuration {config}:\n{exception}"
+                ) from exception
+
+
+def report_profile(profiler: Profiler, path: str):
+    """Stop a profiler, then write its stacks and print its summary"""
+    profiler.stop()
+    profiler.write_stacks(path)
+    click.echo(profiler.get_summary(), err=True)
+    click.echo(f"Collapsed stacks written to {path}", err=True)
+
+
+@cli.command(short_help="Validate the configuration for an organization")
+@click.argument("organization", required=False)
+@click.pass_context
+def validate(ctx, organization):
+    """Validate a local configuration (--config) or the organizational configuration"""
+    if ctx.parent.params["config"]:
+        # Already compiled, and therefore validated, by the cli group
+        click.echo(f"Configuration {ctx.parent.params['config']} is valid")
+        return
+    if not organization:
+        raise click.UsageError("Either --config or ORGANIZATION is required")
+    try:
+        org = OrganizerOrganization(gh.get_organization(organization))
+    except ConfigurationError as exception:
+        raise click.ClickException(
+            f"Invalid configuration for {organization}:\n{exception}"
+        ) from exception
+    if not org.has_configuration:
+        raise click.ClickException(f"{organization} has no .github/organizer.yaml")
+    click.echo(f"Configuration for {organization} is valid")
+
+
+def get_organization(organization: str, snapshot: str = None):
+    """Get an organization from the API or, without any API access, a snapshot"""
+    if not snapshot:
+        return OrganizerOrganization(gh.get_organization(organization))
+    try:
+        org = SnapshotOrganization(Snapshot(snapshot))
+    except SnapshotError as exception:
+        raise click.ClickException(str(exception)) from exception
+    if org.login.lower() != organization.lower():
+        raise click.ClickException(f"{snapshot} is a snapshot of {org.login}")
+    return org
+
+
+snapshot_option = click.option(
+    "--snapshot",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Read the organization from a snapshot file instead of the API",
+)
 
 
 @cli.command(short_help="List the settings for an organization or repository")
 @click.argument("organization")
 @click.argument("repository", required=False)
-@click.pass_context
-def settings(organization, repository):
+@snapshot_option
+def settings(organization, repository, snapshot):
     """Displays the settings for an Organization or Repository"""
-    org = OrganizerOrganization(gh.get_organization(organization))
+    org = get_organization(organization, snapshot)
     if repository:
-        repo = org.get_repository(repository)
-        click.echo(f"Organizer Settings for: {org.login}/{repo.name}")
-        click.echo(yaml.dump(repo.get_organizer_settings(), default_flow_style=False))
+        if snapshot:
+            listing = (org.snapshot.get_repository(repository) or ({},))[0]
+            if not listing:
+                raise click.ClickException(f"{repository} is not in the snapshot")
+            profile = org.get_profile(repository, listing["topics"] or [])
+        else:
+            profile = org.get_repository(repository).get_organizer_settings()
+        click.echo(f"Organizer Settings for: {org.login}/{repository}")
+        with phase("dump"):
+            output = yaml.dump(
+                profile.to_dict() if profile else {}, default_flow_style=False
+            )
+        click.echo(output)
     else:
         click.echo(f"Organizer Settings for: {org.name} ({org.login})")
-        click.echo(yaml.dump(org.configuration, default_flow_style=False))
-    # print(repo.name)
+        with phase("dump"):
+            output = yaml.dump(org.configuration.to_dict(), default_flow_style=False)
+        click.echo(output)
+
+
+@cli.command(short_help="Write the state of an organization to a snapshot file")
+@click.argument("organization")
+@click.argument("path", type=click.Path(dir_okay=False))
+def snapshot(organization, path):
+    """Store repositories, flags, topics, labels and protection for offline use"""
+    org = OrganizerOrganization(gh.get_organization(organization))
+    write_snapshot(org, path).close()
+    click.echo(f"Snapshot of {org.login} written to {path}")
+
+
+@cli.command(short_help="List what differs from the configuration in an organization")
+@click.argument("organization")
+@snapshot_option
+def audit(organization, snapshot):
+    """Audit every repository, offline when a snapshot is given"""
+    if snapshot:
+        org = get_organization(organization, snapshot)
+    else:
+        live = OrganizerOrganization(gh.get_organization(organization))
+        org = SnapshotOrganization(Snapshot(write_snapshot(live, ":memory:")))
+    drifted = 0
+    for name, findings in audit_organization(org):
+        drifted += bool(findings)
+        for finding in findings:
+            click.echo(f"{org.login}/{name}: {finding}")
+    click.echo(f"{drifted} repositories differ from the configuration")
 
 
 @cli.command(short_help="Update a single repository's settings")
@@ -58,33 +202,191 @@ def update_repo(organization, repository):
     update_repository_security_settings(organization, repository)
 
 
+@cli.command(short_help="Stream all repositories of an organization through a sync")
+@click.argument("organization")
+@click.option("--workers", default=DEFAULT_WORKERS, help="Concurrent API writers")
+@click.option("--window", default=DEFAULT_WINDOW, help="Repositories held in memory")
+@click.option("--dry-run", is_flag=True, help="Only report the changes")
+@click.option(
+    "--batch-size",
+    default=DEFAULT_BATCH_SIZE,
+    help="GraphQL mutations per request, 0 to only use REST",
+)
+@click.option("--max-seconds", type=float, help="Stop picking up repositories after")
+@click.option("--max-requests", type=int, help="API requests the run may make")
+@click.option(
+    "--prioritize/--no-prioritize",
+    default=True,
+    help="Sync unprotected, new, drifted and stale repositories first",
+)
+@snapshot_option
+def sync(
+    organization,
+    workers,
+    window,
+    dry_run,
+    batch_size,
+    max_seconds,
+    max_requests,
+    prioritize,
+    snapshot,
+):
+    """Sync the general settings, default branch and its protection of every repository"""
+    if snapshot and not dry_run:
+        raise click.UsageError("--snapshot can only plan, add --dry-run")
+    org = get_organization(organization, snapshot)
+
+    def report(name, changes):
+        if changes:
+            click.echo(f"{org.login}/{name}: {', '.join(sorted(changes))}")
+
+    if snapshot:
+        repositories = changed = 0
+        for name, changes in plan_settings(org):
+            repositories += 1
+            changed += bool(changes)
+            report(name, changes)
+        click.echo(f"{changed} of {repositories} repositories need changes")
+        return
+
+    budget = SyncBudget(max_seconds, max_requests)
+    state = SyncState(org.login) if prioritize else None
+    results = sync_organization(
+        org, workers, window, dry_run, report, batch_size, budget, state
+    )
+    click.echo(
+        f"{results['changed']} of {results['repositories']} repositories "
+        f"{'need changes' if dry_run else 'updated'} in {budget.used} requests"
+    )
+    if results["errors"]:
+        click.echo(f"{results['errors']} repositories failed to update")
+    if results["stopped"]:
+        skipped = f" with {results['skipped']} left" if results["skipped"] else ""
+        click.echo(f"Stopped at the run budget{skipped}")
+
+
+def open_queue(path: str) -> WorkQueue:
+    """Open a work queue, reporting unusable files as CLI errors"""
+    try:
+        return WorkQueue(path)
+    except QueueError as exception:
+        raise click.ClickException(str(exception)) from exception
+
+
+@cli.command(short_help="Queue the repository tasks of an organization for workers")
+@click.argument("organization")
+@click.argument("queue", type=click.Path(dir_okay=False))
+@click.option(
+    "--task",
+    "tasks",
+    multiple=True,
+    type=click.Choice(list(QUEUE_TASKS)),
+    help="Tasks to queue per repository, all of them by default",
+)
+def enqueue(organization, queue, tasks):
+    """Fill a work queue that any number of worker processes can share"""
+    org = OrganizerOrganization(gh.get_organization(organization))
+    work_queue = open_queue(queue)
+    try:
+        added = fill_queue(org, work_queue, list(tasks or QUEUE_TASKS))
+    except QueueError as exception:
+        raise click.ClickException(str(exception)) from exception
+    click.echo(f"Queued {added} tasks for {org.login} in {queue}")
+
+
+@cli.command(short_help="Process the tasks of a work queue until it is finished")
+@click.argument("queue", type=click.Path(exists=True, dir_okay=False))
+@click.option("--worker-id", default=get_worker_id, help="Name of this worker")
+@click.option(
+    "--lease-seconds",
+    default=DEFAULT_LEASE_SECONDS,
+    help="Seconds before an unacknowledged task is retried elsewhere",
+)
+@click.option("--count", default=DEFAULT_LEASE_COUNT, help="Tasks leased at once")
+def worker(queue, worker_id, lease_seconds, count):
+    """Lease, apply and acknowledge tasks, alongside any other workers"""
+    work_queue = open_queue(queue)
+    login = work_queue.get_login()
+    if not login:
+        raise click.ClickException(f"{queue} has no tasks queued")
+    org = OrganizerOrganization(gh.get_organization(login))
+    processed = run_worker(org, work_queue, worker_id, lease_seconds, count)
+    click.echo(f"Worker {worker_id} processed {processed} tasks")
+
+
+@cli.command(short_help="Merge the results of every worker of a work queue")
+@click.argument("queue", type=click.Path(exists=True, dir_okay=False))
+def queue_report(queue):
+    """Report the task states, worker totals and failures of a work queue"""
+    report = open_queue(queue).get_report()
+    for task, states in sorted(report["tasks"].items()):
+        counts = ", ".join(
+            f"{count} {state}" for state, count in sorted(states.items())
+        )
+        click.echo(f"{task}: {counts}")
+    for worker_id, (done, seconds) in sorted(report["workers"].items()):
+        click.echo(f"{worker_id}: {done} tasks in {seconds:.1f}s")
+    for repository, task, error in report["failures"]:
+        click.echo(f"Failed {task} for {repository}: {error}")
+
+
 # @cli.command(short_help="Update all repositories in an organization")
 # @click.argument('organization')
 # def update_repos(organization):
 #     tasks.github.update_organization_settings(organization, True)
 
 
-# @cli.command(short_help="Update repository teams for an organization")
-# @click.argument('organization')
-# def update_team_repos(organization):
-#     tasks.github.update_organization_teams(organization)
+@cli.command(short_help="Update the labels of every repository in an organization")
+@click.argument("organization")
+@click.option(
+    "--batch-size", default=DEFAULT_BATCH_SIZE, help="GraphQL mutations per request"
+)
+@click.option("--dry-run", is_flag=True, help="Only report the changes")
+@snapshot_option
+def update_labels(organization, batch_size, dry_run, snapshot):
+    """Create, update and remove labels across an organization in batches"""
+    if snapshot and not dry_run:
+        raise click.UsageError("--snapshot can only plan, add --dry-run")
+    org = get_organization(organization, snapshot)
+    changed, batch = update_organization_labels(org, batch_size, dry_run)
+    click.echo(
+        f"{changed} label changes in {batch.requests} requests, "
+        f"{len(batch.errors)} errors"
+    )
+
+
+@cli.command(short_help="Update repository teams for an organization")
+@click.argument("organization")
+@click.option("--workers", default=DEFAULT_WORKERS, help="Concurrent API writers")
+@click.option("--dry-run", is_flag=True, help="Only report the changes")
+def update_team_repos(organization, workers, dry_run):
+    """Sync the team repository permissions from the teams configuration"""
+    org = OrganizerOrganization(gh.get_organization(organization))
+    changes = update_organization_teams(org, workers, dry_run)
+    click.echo(f"{len(changes)} team permission changes for {org.login}")
 
 
-# @cli.command(short_help="Update repository teams for an organization")
-# @click.argument('organization')
-# @click.argument('team')
-# def get_team_permissions(organization, team):
-#     installation = ghapp.get_org_installation(organization)
-#     gh = get_organization_client(organization)
-#     org = models.gh.Organization(gh, organization)
-#     team = org.get_team_by_name(team)
-#     click.echo(models.gh.team_has_repositories(installation, team))
+@cli.command(short_help="List the repository permissions of a team")
+@click.argument("organization")
+@click.argument("team")
+def get_team_permissions(organization, team):
+    """List the repositories and permissions of a team"""
+    team = gh.get_organization(organization).get_team_by_slug(team)
+    for repo_name, permission in sorted(get_team_repository_permissions(team).items()):
+        click.echo(f"{repo_name}\t{permission}")
 
 
 @cli.command(short_help="List the repositories in an organization")
 @click.argument("organization")
-def list_repos(organization):
+@snapshot_option
+def list_repos(organization, snapshot):
     """List all the repositories for an Organization"""
+    if snapshot:
+        org = get_organization(organization, snapshot)
+        for listing, _ in org.snapshot.get_repositories():
+            if not org.is_excluded(RepositoryRecord(listing)):
+                click.echo(listing["name"])
+        return
     org = OrganizerOrganization(gh.get_organization(organization))
     for repo in org.get_repositories():
         click.echo(repo.name)
@@ -138,16 +440,39 @@ def list_repos(organization):
 )
 @click.argument("organization")
 @click.argument("repository", required=False)
-def update_branch_protection(organization, repository):
+@click.option(
+    "--rulesets",
+    is_flag=True,
+    help="Apply shared branch policies as organization rulesets",
+)
+@click.option("--dry-run", is_flag=True, help="Only report the ruleset changes")
+def update_branch_protection(organization, repository, rulesets, dry_run):
     """Update the branch protection rules for an Organization or single Repository"""
     org = OrganizerOrganization(gh.get_organization(organization))
     if repository:
         update_org_repo_branch_protection(org, repository)
+    elif rulesets:
+        update_organization_rulesets(org, dry_run)
     else:
         for repo in org.get_repositories():
             update_repo_branch_protection(repo)
 
 
+@cli.command(
+    short_help="Update the security settings for an entire org or single repository"
+)
+@click.argument("organization")
+@click.argument("repository", required=False)
+def update_security(organization, repository):
+    """Update Dependabot security settings for an Organization or single Repository"""
+    if repository:
+        update_repository_security_settings(organization, repository)
+    else:
+        update_organization_security_settings(
+            OrganizerOrganization(gh.get_organization(organization))
+        )
+
+
 @cli.command(
     short_help="Update the default branch settings for an entire org or single repository"
 )
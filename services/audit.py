@@ -0,0 +1,101 @@
+"""Audit of an organization snapshot against the configuration"""
+from models.gh import ruleset_covers, value_or
+from models.records import RepositoryRecord
+from models.schema import BranchPolicy
+from models.snapshot import SnapshotOrganization
+
+# Branch policy keys and the matching GraphQL branch protection rule fields
+PROTECTION_FIELDS = {
+    "dismiss_stale_reviews": "dismissesStaleReviews",
+    "require_code_owner_reviews": "requiresCodeOwnerReviews",
+    "required_linear_history": "requiresLinearHistory",
+    "allow_force_pushes": "allowsForcePushes",
+    "required_conversation_resolution": "requiresConversationResolution",
+    "lock_branch": "lockBranch",
+    "block_creations": "blocksCreations",
+}
+
+
+def get_protection_drift(branch: str, policy: BranchPolicy, rules: list) -> list:
+    """Compare a branch policy with the branch protection rules of a repository"""
+    rule = next((x for x in rules if x["pattern"] == branch), None)
+    if policy.require_review is False:
+        return [f"protection: {branch} should not be protected"] if rule else []
+    if rule is None:
+        return [f"protection: {branch} is not protected"]
+    wanted = {
+        "isAdminEnforced": policy.enforce_admins is not False,
+        "requiredApprovingReviewCount": value_or(
+            policy.required_approving_review_count, 1
+        ),
+    }
+    for key, field in PROTECTION_FIELDS.items():
+        if getattr(policy, key) is not None:
+            wanted[field] = getattr(policy, key)
+    checks = policy.required_status_checks
+    if checks:
+        wanted["requiresStrictStatusChecks"] = bool(checks.strict)
+        wanted["requiredStatusCheckContexts"] = sorted(checks.contexts or [])
+        contexts = sorted(rule["requiredStatusCheckContexts"] or [])
+        rule = dict(rule, requiredStatusCheckContexts=contexts)
+    return [
+        f"protection: {branch} {field} is {rule.get(field)}, wants {value}"
+        for field, value in wanted.items()
+        if rule.get(field) != value
+    ]
+
+
+def audit_repository(org: SnapshotOrganization, listing: dict, details: dict) -> list:
+    """Get everything in a repository that differs from its profile"""
+    record = RepositoryRecord(listing)
+    record.profile = org.get_profile(record.name, record.topics)
+    findings = [
+        f"settings: {key} wants {value}" for key, value in record.get_changes().items()
+    ]
+    if details:
+        findings += [
+            f"labels: {mutation} {name}"
+            for name, mutation, _ in org.get_label_mutations(details)
+        ]
+    if not record.profile:
+        return findings
+
+    security = record.profile.dependency_security or {}
+    if details and "alerts" in security:
+        if details["hasVulnerabilityAlertsEnabled"] != security["alerts"]:
+            findings.append(f"security: alerts wants {security['alerts']}")
+    analysis = listing.get("security_and_analysis") or {}
+    if "automatic_fixes" in security and "dependabot_security_updates" in analysis:
+        enabled = analysis["dependabot_security_updates"].get("status") == "enabled"
+        if enabled != security["automatic_fixes"]:
+            findings.append(
+                f"security: automatic_fixes wants {security['automatic_fixes']}"
+            )
+
+    rules = (details or {}).get("branchProtectionRules") or []
+    rulesets = (details or {}).get("rulesets") or []
+    for branch, policy in (record.profile.branches or {}).items():
+        # Branches under a ruleset are governed by it, not by a classic rule
+        default = branch == record.default_branch
+        if any(ruleset_covers(x, branch, default) for x in rulesets):
+            continue
+        findings += get_protection_drift(branch, policy, rules)
+    return findings
+
+
+def plan_settings(org: SnapshotOrganization):
+    """Yield the repository flag changes a sync would make, without API calls"""
+    for listing, _ in org.snapshot.get_repositories():
+        record = RepositoryRecord(listing)
+        if org.is_excluded(record):
+            continue
+        record.profile = org.get_profile(record.name, record.topics)
+        yield record.name, record.get_changes()
+
+
+def audit_organization(org: SnapshotOrganization):
+    """Yield the findings for every repository in a snapshot, without API calls"""
+    for listing, details in org.snapshot.get_repositories():
+        if org.is_excluded(RepositoryRecord(listing)):
+            continue
+        yield listing["name"], audit_repository(org, listing, details)
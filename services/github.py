@@ -7,4 +7,5 @@ from github import Auth, Github
 auth = Auth.Token(os.getenv("ORG_TOKEN"))
 # First create a Github instance:
 # Public Web Github
-gh = Github(auth=auth)
+# The largest page size keeps listings at a request per 100 repositories
+gh = Github(auth=auth, per_page=100)
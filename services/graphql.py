@@ -0,0 +1,134 @@
+"""Batched GraphQL mutations for write-heavy rollouts"""
+import re
+import threading
+
+from github.GithubException import GithubException
+
+from models.gh import OrganizerOrganization
+from models.profiling import timed
+from models.records import RepositoryRecord
+
+DEFAULT_BATCH_SIZE = 50
+MUTATION_INPUTS = {
+    "createLabel": "CreateLabelInput!",
+    "updateLabel": "UpdateLabelInput!",
+    "deleteLabel": "DeleteLabelInput!",
+    "updateRepository": "UpdateRepositoryInput!",
+}
+# The repository flags UpdateRepositoryInput accepts, everything else needs REST
+REPOSITORY_FIELDS = {
+    "has_issues": "hasIssuesEnabled",
+    "has_projects": "hasProjectsEnabled",
+    "has_wiki": "hasWikiEnabled",
+}
+LABELS_PREVIEW = {"Accept": "application/vnd.github.bane-preview+json"}
+VARIABLE_PATTERN = re.compile(r"\$i(\d+)")
+
+
+class MutationBatch:
+    """Packs many mutations into aliased GraphQL requests"""
+
+    def __init__(self, org: OrganizerOrganization, batch_size=DEFAULT_BATCH_SIZE):
+        """Initialize Class"""
+        self.org = org
+        self.batch_size = batch_size
+        self.pending = []
+        self.errors = []
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def add(self, key, mutation: str, mutation_input: dict):
+        """Queue a mutation, sending the batch once it is full"""
+        with self.lock:
+            self.pending.append((key, mutation, mutation_input))
+            if len(self.pending) < self.batch_size:
+                return
+            batch, self.pending = self.pending, []
+        self.send(batch)
+
+    def flush(self):
+        """Send any queued mutations"""
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if batch:
+            self.send(batch)
+
+    @timed("write")
+    def send(self, batch: list):
+        """Send a batch of mutations as a single request"""
+        parameters = []
+        fields = []
+        variables = {}
+        for index, (_, mutation, mutation_input) in enumerate(batch):
+            parameters.append(f"$i{index}: {MUTATION_INPUTS[mutation]}")
+            fields.append(
+                f"  m{index}: {mutation}(input: $i{index}) {{ clientMutationId }}"
+            )
+            variables[f"i{index}"] = mutation_input
+        query = "mutation(%s) {\n%s\n}" % (", ".join(parameters), "\n".join(fields))
+        with self.lock:
+            self.requests += 1
+        try:
+            response = self.org.graphql(query, variables, LABELS_PREVIEW)
+        except GithubException as exception:
+            self.add_errors([(key, str(exception)) for key, _, _ in batch])
+            return
+        errors = []
+        for error in response.get("errors") or []:
+            errors.append((self.get_error_key(batch, error), error.get("message")))
+        self.add_errors(errors)
+
+    @staticmethod
+    def get_error_key(batch: list, error: dict):
+        """Map a GraphQL error back to the key of the mutation that caused it"""
+        path = error.get("path") or []
+        if path and str(path[0]).startswith("m"):
+            index = int(path[0][1:])
+        else:
+            # Invalid inputs fail the whole request and only name the variable
+            match = VARIABLE_PATTERN.search(error.get("message", ""))
+            index = int(match.group(1)) if match else None
+        if index is None or index >= len(batch):
+            return None
+        return batch[index][0]
+
+    def add_errors(self, errors: list):
+        """Record and report failed mutations"""
+        with self.lock:
+            self.errors.extend(errors)
+        for key, message in errors:
+            print(f"Error updating {key}: {message}")
+
+
+def get_repository_input(node_id: str, changes: dict):
+    """Get the UpdateRepositoryInput for changes, or None if REST is needed"""
+    if not node_id or not changes or any(x not in REPOSITORY_FIELDS for x in changes):
+        return None
+    repository_input = {"repositoryId": node_id}
+    for key, value in changes.items():
+        repository_input[REPOSITORY_FIELDS[key]] = value
+    return repository_input
+
+
+def update_organization_labels(
+    org: OrganizerOrganization, batch_size: int = DEFAULT_BATCH_SIZE, dry_run=False
+):
+    """Update the labels of every repository using batched mutations"""
+    print(f"Updating the labels of organization {org.login}")
+    changed = 0
+    with MutationBatch(org, batch_size) as batch:
+        for node in org.get_repository_labels():
+            if org.is_excluded(RepositoryRecord(node)):
+                continue
+            for label_name, mutation, mutation_input in org.get_label_mutations(node):
+                changed += 1
+                print(f"{mutation} {label_name} in {org.login}/{node['name']}")
+                if not dry_run:
+                    batch.add((node["name"], label_name), mutation, mutation_input)
+    return changed, batch
@@ -0,0 +1,236 @@
+"""Streaming sync pipeline that keeps a bounded number of repositories in memory"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from github.GithubException import GithubException
+
+from models.gh import OrganizerOrganization, get_listing_pages
+from models.profiling import timed
+from models.records import RepositoryRecord
+from models.schema import BranchPolicy
+from services.graphql import DEFAULT_BATCH_SIZE, MutationBatch, get_repository_input
+from services.scheduler import SyncBudget, SyncScheduler, SyncState
+
+DEFAULT_WORKERS = 8
+DEFAULT_WINDOW = 64
+
+
+def stream_records(
+    org: OrganizerOrganization,
+    excluded: list = None,
+    budget: SyncBudget = None,
+    details: bool = False,
+):
+    """Yield a compact record per repository, one listing page at a time"""
+    for listing in get_listing_pages(org.org, budget):
+        included = []
+        for repository in listing:
+            if not org.is_excluded(repository):
+                included.append(repository)
+            elif excluded is not None:
+                excluded.append(repository.name)
+        # The listing lacks the merge settings and protection, GraphQL reads them
+        # for the page only, so they are dropped with it
+        data = {}
+        if details and included:
+            if budget and not budget.read():
+                return
+            nodes = org.get_repository_records([x.node_id for x in included])
+            data = {x["node_id"]: x for x in nodes}
+        for repository in included:
+            yield RepositoryRecord.from_repository(
+                org, repository, data.get(repository.node_id)
+            )
+
+
+def read_records(org: OrganizerOrganization, node_ids, budget: SyncBudget = None):
+    """Yield the records of repositories by node ID, 100 per request"""
+    node_ids = iter(node_ids)
+    while True:
+        chunk = list(islice(node_ids, 100))
+        if not chunk or (budget and not budget.read()):
+            return
+        for data in org.get_repository_records(chunk):
+            yield RepositoryRecord.from_data(org, data)
+
+
+@timed("write")
+def write_changes(
+    org: OrganizerOrganization,
+    record: RepositoryRecord,
+    changes: dict,
+    budget: SyncBudget = None,
+):
+    """Apply changed repository flags with a single PATCH"""
+    url = f"/repos/{org.login}/{record.name}"
+    if budget:
+        budget.spend()
+    try:
+        org.org._requester.requestJsonAndCheck("PATCH", url, input=changes)
+    except GithubException:
+        if "default_branch" not in changes:
+            raise
+        # The default branch may not exist yet, keep the rest of the changes
+        changes = {x: changes[x] for x in changes if x != "default_branch"}
+        if changes:
+            if budget:
+                budget.spend()
+            org.org._requester.requestJsonAndCheck("PATCH", url, input=changes)
+
+
+def complete_record(
+    org: OrganizerOrganization, record: RepositoryRecord, budget: SyncBudget = None
+):
+    """Read the flags no bulk read returns, once and only if the profile sets them"""
+    if not record.get_unknown_settings():
+        return
+    if budget:
+        budget.spend()
+    _, data = org.org._requester.requestJsonAndCheck(
+        "GET", f"/repos/{org.login}/{record.name}"
+    )
+    record.update_settings(data)
+
+
+def protect_branch(
+    org: OrganizerOrganization,
+    record: RepositoryRecord,
+    branch: str,
+    policy: BranchPolicy,
+    budget: SyncBudget = None,
+):
+    """Apply the branch policy to a default branch found unprotected"""
+    if budget:
+        budget.spend(3)
+    repo = org.get_repository(record.name)
+    if repo is None:
+        raise GithubException(404, f"{record.name} was not found", None)
+    repo.branch_protection(repo.repository.get_branch(branch), policy)
+
+
+def sync_record(
+    org: OrganizerOrganization,
+    record: RepositoryRecord,
+    dry_run: bool,
+    batch: MutationBatch = None,
+    budget: SyncBudget = None,
+):
+    """Diff a repository record against its profile and write the differences"""
+    # Returns the name, the changes and whether writing them failed
+    try:
+        complete_record(org, record, budget)
+    except GithubException as exception:
+        print(f"Error reading {org.login}/{record.name}: {exception}")
+    changes = record.get_changes()
+    failed = False
+    if changes and not dry_run:
+        repository_input = batch and get_repository_input(record.node_id, changes)
+        if repository_input:
+            batch.add((record.name, None), "updateRepository", repository_input)
+        else:
+            try:
+                write_changes(org, record, changes, budget)
+            except GithubException as exception:
+                print(f"Error updating {org.login}/{record.name}: {exception}")
+                failed = True
+    branch, policy = record.get_default_branch_policy()
+    if policy and record.protected is False:
+        if not dry_run:
+            try:
+                protect_branch(org, record, branch, policy, budget)
+            except GithubException as exception:
+                print(
+                    f"Error protecting {branch} in {org.login}/{record.name}: {exception}"
+                )
+                failed = True
+        changes = dict(changes, branch_protection=branch)
+    return record.name, changes, failed
+
+
+def get_batch_requests(batch: MutationBatch) -> int:
+    """Count the requests of a mutation batch, including the ones still queued"""
+    if not batch:
+        return 0
+    return batch.requests + -(-len(batch.pending) // batch.batch_size)
+
+
+def get_repository_count(org: OrganizerOrganization) -> int:
+    """Count the repositories of an organization from its profile"""
+    return (org.org.public_repos or 0) + (org.org.total_private_repos or 0)
+
+
+def sync_organization(
+    org: OrganizerOrganization,
+    workers: int = DEFAULT_WORKERS,
+    window: int = DEFAULT_WINDOW,
+    dry_run: bool = False,
+    callback=None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    budget: SyncBudget = None,
+    state: SyncState = None,
+):
+    """Stream every repository through diff and write with a bounded window"""
+    # With a state the riskiest and stalest repositories are synced first
+    in_flight = threading.BoundedSemaphore(window)
+    results = {
+        "repositories": 0,
+        "changed": 0,
+        "errors": 0,
+        "stopped": False,
+        "skipped": 0,
+    }
+    lock = threading.Lock()
+
+    def done(future):
+        in_flight.release()
+        name, changes, failed = future.result()
+        if state and not dry_run:
+            state.update(name, bool(changes))
+        with lock:
+            results["repositories"] += 1
+            results["changed"] += bool(changes) and not failed
+            results["errors"] += failed
+            if callback:
+                callback(name, changes)
+
+    # Flags GraphQL can set are packed into batched mutations, the rest use REST
+    batch = MutationBatch(org, batch_size) if batch_size else None
+    excluded = []
+    records = stream_records(org, excluded, budget, details=True)
+    if state:
+        records = read_records(org, SyncScheduler(state).order(records), budget)
+    submitted = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            # Blocks the listing until a slot frees up, which bounds memory
+            in_flight.acquire()  # pylint: disable=consider-using-with
+            # Writes already in flight finish, only new repositories are skipped.
+            # Checked before the next record, whose listing page may need a read
+            if budget and budget.exhausted(get_batch_requests(batch)):
+                budget.stopped = True
+            record = None if budget and budget.stopped else next(records, None)
+            if record is None:
+                in_flight.release()
+                break
+            submitted += 1
+            executor.submit(
+                sync_record, org, record, dry_run, batch, budget
+            ).add_done_callback(done)
+    if budget and budget.stopped:
+        results["stopped"] = True
+        # Excluded repositories not listed yet are counted as skipped too
+        results["skipped"] = max(
+            get_repository_count(org) - submitted - len(excluded), 0
+        )
+    if batch:
+        batch.flush()
+        if budget:
+            budget.spend(batch.requests)
+        # Queued mutations counted as changed until their batch reported an error
+        failed = {key[0] for key, _ in batch.errors if key}
+        results["changed"] -= len(failed)
+        results["errors"] += len(failed) + sum(1 for key, _ in batch.errors if not key)
+    if state and not dry_run:
+        state.save()
+    return results
@@ -0,0 +1,220 @@
+"""Organization rulesets compiled from the branch policies of the profiles"""
+import hashlib
+
+from models.gh import OrganizerOrganization, value_or
+from models.schema import BranchPolicy
+from services.pipeline import stream_records
+from services.tasks import update_branch_protection
+
+RULESET_PREFIX = "organizer/"
+MAX_RULESET_NAME = 100
+# Lets organization admins bypass the ruleset, the counterpart of enforce_admins
+ADMIN_BYPASS = {
+    "actor_id": 1,
+    "actor_type": "OrganizationAdmin",
+    "bypass_mode": "always",
+}
+
+
+def get_ruleset_rules(policy: BranchPolicy):
+    """Convert a branch policy to ruleset rules, None if it needs branch protection"""
+    # Push, dismissal and bypass restrictions need actor ids rulesets can't take
+    if policy.restrictions or policy.dismissal_restrictions:
+        return None
+    if policy.bypass_restrictions or policy.require_review is False:
+        return None
+    rules = [{"type": "deletion"}]
+    if not policy.allow_force_pushes:
+        rules.append({"type": "non_fast_forward"})
+    if policy.required_linear_history:
+        rules.append({"type": "required_linear_history"})
+    if policy.block_creations:
+        rules.append({"type": "creation"})
+    if policy.lock_branch:
+        rules.append(
+            {
+                "type": "update",
+                "parameters": {
+                    "update_allows_fetch_and_merge": bool(policy.allow_fork_syncing)
+                },
+            }
+        )
+    rules.append(
+        {
+            "type": "pull_request",
+            "parameters": {
+                "required_approving_review_count": value_or(
+                    policy.required_approving_review_count, 1
+                ),
+                "dismiss_stale_reviews_on_push": bool(policy.dismiss_stale_reviews),
+                "require_code_owner_review": bool(policy.require_code_owner_reviews),
+                "require_last_push_approval": False,
+                "required_review_thread_resolution": bool(
+                    policy.required_conversation_resolution
+                ),
+            },
+        }
+    )
+    checks = policy.required_status_checks
+    if checks and checks.contexts:
+        rules.append(
+            {
+                "type": "required_status_checks",
+                "parameters": {
+                    "strict_required_status_checks_policy": bool(checks.strict),
+                    "required_status_checks": [{"context": x} for x in checks.contexts],
+                },
+            }
+        )
+    return rules
+
+
+def get_ruleset_name(branch: str, profile_names: list) -> str:
+    """Get a stable ruleset name for the profiles sharing a branch policy"""
+    name = f"{RULESET_PREFIX}{branch}/{'+'.join(sorted(profile_names))}"
+    if len(name) > MAX_RULESET_NAME:
+        digest = hashlib.sha1(name.encode("utf-8")).hexdigest()[:12]
+        name = f"{RULESET_PREFIX}{branch}/{digest}"
+    return name
+
+
+def compile_rulesets(org: OrganizerOrganization):
+    """Group profiles with identical branch policies into organization rulesets"""
+    # Also returns the branches per repository that need classic branch protection
+    excluded = []
+    assignments = {}
+    for record in stream_records(org, excluded):
+        profile_name = org.get_profile_name(record.name, record.topics)
+        assignments.setdefault(profile_name, []).append(record.name)
+
+    groups = {}
+    fallback = {}
+    for profile_name, profile in org.configuration.repositories.items():
+        for branch, policy in ((profile and profile.branches) or {}).items():
+            if get_ruleset_rules(policy) is None:
+                for repo_name in assignments.get(profile_name, []):
+                    fallback.setdefault(repo_name, []).append(branch)
+            else:
+                groups.setdefault((branch, policy), []).append(profile_name)
+
+    rulesets = []
+    for (branch, policy), profile_names in groups.items():
+        if "default" in profile_names:
+            # Targets new repositories too, so only the others need listing
+            include = ["~ALL"]
+            exclude = excluded + [
+                repo_name
+                for profile_name, repo_names in assignments.items()
+                if profile_name not in profile_names
+                for repo_name in repo_names
+            ]
+        else:
+            # Rulesets can't match topics, so topic assignments become names
+            include = [
+                repo_name
+                for profile_name in profile_names
+                for repo_name in assignments.get(profile_name, [])
+            ]
+            exclude = []
+            if not include:
+                continue
+        bypass_actors = [ADMIN_BYPASS] if policy.enforce_admins is False else []
+        rulesets.append(
+            {
+                "name": get_ruleset_name(branch, profile_names),
+                "target": "branch",
+                "enforcement": "active",
+                "bypass_actors": bypass_actors,
+                "conditions": {
+                    "ref_name": {"include": [f"refs/heads/{branch}"], "exclude": []},
+                    "repository_name": {
+                        "include": sorted(include),
+                        "exclude": sorted(exclude),
+                    },
+                },
+                "rules": get_ruleset_rules(policy),
+            }
+        )
+    return rulesets, fallback
+
+
+def ruleset_matches(wanted, current) -> bool:
+    """Check if every value of the compiled ruleset is already set"""
+    if isinstance(wanted, dict):
+        if not isinstance(current, dict):
+            return False
+        if "rules" in wanted:
+            wanted = dict(wanted, rules=sorted(wanted["rules"], key=rule_type))
+            current = dict(
+                current, rules=sorted(current.get("rules") or [], key=rule_type)
+            )
+        return all(ruleset_matches(wanted[x], current.get(x)) for x in wanted)
+    if isinstance(wanted, list):
+        if not isinstance(current, list) or len(wanted) != len(current):
+            return False
+        return all(ruleset_matches(x, y) for x, y in zip(wanted, current))
+    return wanted == current
+
+
+def rule_type(rule: dict) -> str:
+    """Sort key for ruleset rules"""
+    return rule.get("type", "")
+
+
+def get_organization_rulesets(org: OrganizerOrganization) -> list:
+    """List every ruleset of an organization, 100 per request"""
+    rulesets = []
+    page = 1
+    while True:
+        _, listing = org.org._requester.requestJsonAndCheck(
+            "GET", f"{org.org.url}/rulesets", parameters={"per_page": 100, "page": page}
+        )
+        rulesets += listing
+        if len(listing) < 100:
+            return rulesets
+        page += 1
+
+
+def update_organization_rulesets(org: OrganizerOrganization, dry_run=False):
+    """Create, update or remove the organization rulesets that only changed"""
+    print(f"Updating the branch rulesets of organization {org.login}")
+    wanted, fallback = compile_rulesets(org)
+    requester = org.org._requester
+    url = f"{org.org.url}/rulesets"
+    existing = {
+        x["name"]: x
+        for x in get_organization_rulesets(org)
+        if x["name"].startswith(RULESET_PREFIX)
+    }
+
+    for ruleset in wanted:
+        current = existing.pop(ruleset["name"], None)
+        if current is None:
+            print(f"Creating ruleset {ruleset['name']}")
+            if not dry_run:
+                requester.requestJsonAndCheck("POST", url, input=ruleset)
+            continue
+        _, current = requester.requestJsonAndCheck("GET", f"{url}/{current['id']}")
+        if ruleset_matches(ruleset, current):
+            continue
+        print(f"Updating ruleset {ruleset['name']}")
+        if not dry_run:
+            requester.requestJsonAndCheck(
+                "PUT", f"{url}/{current['id']}", input=ruleset
+            )
+    for stale in existing.values():
+        print(f"Removing ruleset {stale['name']}")
+        if not dry_run:
+            requester.requestJsonAndCheck("DELETE", f"{url}/{stale['id']}")
+
+    # Policies rulesets can't express keep using per repository branch protection
+    for repo_name, branches in fallback.items():
+        if dry_run:
+            print(
+                f"Branch protection for {', '.join(branches)} in {org.login}/{repo_name}"
+            )
+            continue
+        repo = org.get_repository(repo_name)
+        for branch in branches:
+            update_branch_protection(repo, branch)
+    return wanted, fallback
@@ -0,0 +1,119 @@
+"""Priority scheduling and run budgets for the sync pipeline"""
+import heapq
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from models.config import CONFIG_CACHE_DIR
+from models.records import RepositoryRecord
+
+# Repositories created within this window are synced before older ones
+RECENTLY_CREATED = 7 * 24 * 60 * 60  # One week
+
+
+class SyncBudget:
+    """Time and API request limits for a single sync run"""
+
+    def __init__(self, seconds: float = None, requests: int = None):
+        """Initialize Class"""
+        self.deadline = time.monotonic() + seconds if seconds else None
+        self.requests = requests
+        self.used = 0
+        self.stopped = False
+        self.lock = threading.Lock()
+
+    def spend(self, count: int = 1):
+        """Count API requests made by the run"""
+        with self.lock:
+            self.used += count
+
+    def read(self, count: int = 1) -> bool:
+        """Spend requests on a read, or stop the run when none are left"""
+        if self.exhausted():
+            self.stopped = True
+            return False
+        self.spend(count)
+        return True
+
+    def exhausted(self, extra: int = 0) -> bool:
+        """Check if the run should stop picking up repositories"""
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            return True
+        return self.requests is not None and self.used + extra >= self.requests
+
+
+class SyncState:
+    """When each repository was last synced and last found drifted"""
+
+    def __init__(self, login: str, path: str = None):
+        """Initialize Class"""
+        self.path = path or os.path.join(CONFIG_CACHE_DIR, f"{login.lower()}-sync.json")
+        self.lock = threading.Lock()
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                self.repositories = json.load(file)
+        except (OSError, ValueError):
+            self.repositories = {}
+
+    def get(self, name: str) -> tuple:
+        """Get the last synced and last drifted times of a repository"""
+        synced, drifted = self.repositories.get(name, (0, 0))
+        return synced, drifted
+
+    def update(self, name: str, drifted: bool):
+        """Record that a repository was synced"""
+        now = int(time.time())
+        with self.lock:
+            previous = self.get(name)[1]
+            self.repositories[name] = (now, now if drifted else previous)
+
+    def save(self):
+        """Store the state for the next run"""
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(f"{self.path}.tmp", "w", encoding="utf-8") as file:
+                json.dump(self.repositories, file)
+            os.replace(f"{self.path}.tmp", self.path)
+        except OSError as exception:
+            print(f"Unable to store the sync state in {self.path}: {exception}")
+
+
+def get_created_time(created_at: str) -> float:
+    """Parse the created_at timestamp of a repository listing"""
+    if not created_at:
+        return 0
+    created = datetime.strptime(created_at, "%Y-%m-%dT%H:%M:%SZ")
+    return created.replace(tzinfo=timezone.utc).timestamp()
+
+
+class SyncScheduler:
+    """Orders repositories so the riskiest and stalest are synced first"""
+
+    def __init__(self, state: SyncState):
+        """Initialize Class"""
+        self.state = state
+        self.queue = []
+        self.now = time.time()
+
+    def get_priority(self, record: RepositoryRecord) -> tuple:
+        """Get the sort key of a repository, lower runs first"""
+        synced, drifted = self.state.get(record.name)
+        created = get_created_time(record.created_at)
+        # Only a missing protection the profile asks for can be fixed by the sync
+        unprotected = record.protected is False
+        return (
+            not unprotected or record.get_default_branch_policy()[1] is None,
+            self.now - created > RECENTLY_CREATED,
+            -drifted,
+            synced,
+        )
+
+    def order(self, records):
+        """Rank every record, then yield their node IDs by priority"""
+        # Only the sort keys are kept, the records are read again in this order
+        for record in records:
+            heapq.heappush(self.queue, (self.get_priority(record), record.node_id))
+        while self.queue:
+            yield heapq.heappop(self.queue)[1]
@@ -1,8 +1,17 @@
 """List of functions for the CLI"""
-from github.GithubObject import NotSet
+from concurrent.futures import ThreadPoolExecutor
 
-from models.gh import OrganizerOrganization, OrganizerRepository
+from github.GithubException import GithubException
+
+from models.gh import (
+    SECURITY_PRODUCTS,
+    OrganizerOrganization,
+    OrganizerRepository,
+    get_listing_pages,
+    get_team_repository_permissions,
+)
 from services.github import gh
+from services.pipeline import DEFAULT_WORKERS, stream_records
 
 
 def update_repository_settings(org_name, repo_name):
@@ -29,6 +38,62 @@ def update_repository_security_settings(org_name, repo_name):
     repo.update_security_scanning()
 
 
+def update_organization_security_settings(org: OrganizerOrganization):
+    """Update security settings for all repositories of an organization"""
+    print(f"Updating the security settings of organization {org.login}")
+    repos = []
+    covers_org = True
+    for listing in get_listing_pages(org.org):
+        for repository in listing:
+            if org.is_excluded(repository):
+                covers_org = False
+                continue
+            repos.append(OrganizerRepository(org, repository))
+    alert_states = org.get_vulnerability_alert_states()
+
+    # Alerts must be handled before automatic fixes, which depend on them
+    for setting in SECURITY_PRODUCTS:
+        wanted = {
+            repo.name: repo.get_security_settings().get(setting) for repo in repos
+        }
+        if setting == "alerts":
+            current = {repo.name: alert_states.get(repo.name) for repo in repos}
+        else:
+            current = {
+                repo.name: repo.get_security_fixes_enabled()
+                for repo in repos
+                if wanted[repo.name] is not None
+            }
+        differing = [
+            repo
+            for repo in repos
+            if wanted[repo.name] is not None and current[repo.name] != wanted[repo.name]
+        ]
+        if not differing:
+            continue
+        values = set(wanted.values())
+        if covers_org and len(values) == 1 and len(differing) > 1:
+            enable = values.pop()
+            print(f"Setting {setting} to {enable} for all repositories in {org.login}")
+            org.toggle_security_product(setting, enable)
+            if setting == "alerts":
+                alert_states = {name: enable for name in alert_states}
+            continue
+        for repo in differing:
+            enable = wanted[repo.name]
+            print(f"Setting {setting} to {enable} for {org.login}/{repo.name}")
+            try:
+                if setting == "alerts":
+                    repo.toggle_vulnerability_alerts(enable)
+                    alert_states[repo.name] = enable
+                else:
+                    repo.toggle_security_fixes(enable)
+            except GithubException as exception:
+                print(
+                    f"Error updating {setting} for {org.login}/{repo.name}: {exception}"
+                )
+
+
 def update_org_repo_branch_protection(org: OrganizerOrganization, repo_name: str):
     """Update Branch Protections for a repository"""
     print(
@@ -41,46 +106,24 @@ def update_org_repo_branch_protection(org: OrganizerOrganization, repo_name: str
 def update_repo_branch_protection(repo: OrganizerRepository):
     """Update Branch Protection settings for a repository"""
     settings = repo.get_organizer_settings()
-    if "branches" not in settings:
+    if not settings or not settings.branches:
         return
-    for branch in settings["branches"]:
+    for branch in settings.branches:
         update_branch_protection(repo, branch)
 
 
 def update_branch_protection(repo: OrganizerRepository, branch_name: str):
     """Update Branch Protection settings for a specific repository branch"""
-    if "branches" not in repo._settings:
+    settings = repo.get_organizer_settings()
+    if not settings or not settings.branches:
         return
-    if branch_name not in repo._settings["branches"]:
+    if branch_name not in settings.branches:
         return
     print(
         f"Updating branch protection for {branch_name} in {repo.organization.login}/{repo.name}."
     )
-    bsettings = repo._settings["branches"][branch_name]
     branch = repo.repository.get_branch(branch_name)
-    repo.branch_protection(
-        branch=branch,
-        required_status_checks=bsettings.get("required_status_checks", NotSet),
-        enforce_admins=bsettings.get("enforce_admins", NotSet),
-        require_review=bsettings.get("require_review", True),
-        restrictions=bsettings.get("restrictions", {}),
-        required_linear_history=bsettings.get("required_linear_history", NotSet),
-        allow_force_pushes=bsettings.get("allow_force_pushes", NotSet),
-        required_approving_review_count=bsettings.get(
-            "required_approving_review_count", 1
-        ),
-        require_code_owner_reviews=bsettings.get("require_code_owner_reviews", NotSet),
-        dismiss_stale_reviews=bsettings.get("dismiss_stale_reviews", NotSet),
-        dismissal_restrictions=bsettings.get("dismissal_restrictions", {}),
-        bypass_restrictions=bsettings.get("bypass_restrictions", {}),
-        lock_branch=bsettings.get("lock_branch", NotSet),
-        allow_fork_syncing=bsettings.get("allow_fork_syncing", NotSet),
-        block_creations=bsettings.get("block_creations", NotSet),
-        required_conversation_resolution=bsettings.get(
-            "required_conversation_resolution", NotSet
-        ),
-        # allow_deletions=bsettings.get("allow_deletions", False),
-    )
+    repo.branch_protection(branch, settings.branches[branch_name])
 
 
 def update_repository_default_branch(org: OrganizerOrganization, repo_name: str):
@@ -88,3 +131,63 @@ def update_repository_default_branch(org: OrganizerOrganization, repo_name: str)
     print(f"Updating the default branch settings of repository {org.name}/{repo_name}")
     repo = org.get_repository(repo_name)
     repo.update_default_branch()
+
+
+def get_team_changes(org: OrganizerOrganization, current: dict) -> list:
+    """Compare the configured team permissions with the current ones"""
+    changes = []
+    for record in stream_records(org):
+        wanted = org.get_team_permissions(record.name, record.topics)
+        for slug, repositories in current.items():
+            have = repositories.get(record.name)
+            want = wanted.get(slug)
+            if want and want != have:
+                changes.append((slug, record.name, want))
+            elif not want and have and org.configuration.teams[slug].clean:
+                changes.append((slug, record.name, None))
+    return changes
+
+
+def update_team_repository(org: OrganizerOrganization, change: tuple):
+    """Grant, change or remove the permission of a team on a repository"""
+    slug, repo_name, permission = change
+    url = f"{org.org.url}/teams/{slug}/repos/{org.login}/{repo_name}"
+    try:
+        if permission:
+            print(f"Granting {slug} {permission} on {org.login}/{repo_name}")
+            org.org._requester.requestJsonAndCheck(
+                "PUT", url, input={"permission": permission}
+            )
+        else:
+            print(f"Removing {slug} from {org.login}/{repo_name}")
+            org.org._requester.requestJsonAndCheck("DELETE", url)
+    except GithubException as exception:
+        print(f"Error updating {slug} on {org.login}/{repo_name}: {exception}")
+
+
+def update_organization_teams(
+    org: OrganizerOrganization, workers: int = DEFAULT_WORKERS, dry_run=False
+):
+    """Update the repository permissions of every configured team"""
+    print(f"Updating the team permissions of organization {org.login}")
+    teams = {
+        team.slug: team
+        for team in org.org.get_teams()
+        if team.slug in org.configuration.teams
+    }
+    for slug in org.configuration.teams:
+        if slug not in teams:
+            print(f"Team {slug} does not exist in {org.login}")
+    # One listing per team instead of one request per team and repository
+    current = {
+        slug: get_team_repository_permissions(team) for slug, team in teams.items()
+    }
+    changes = get_team_changes(org, current)
+    if dry_run:
+        for slug, repo_name, permission in changes:
+            print(f"{slug} on {org.login}/{repo_name}: {permission or 'remove'}")
+        return changes
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for change in changes:
+            executor.submit(update_team_repository, org, change)
+    return changes
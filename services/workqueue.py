@@ -0,0 +1,232 @@
+"""Durable work queue to split an organization across worker processes"""
+import json
+import os
+import socket
+import sqlite3
+import time
+from itertools import islice
+
+from github.GithubException import GithubException
+
+from models.gh import OrganizerOrganization, OrganizerRepository
+from services.pipeline import stream_records
+from services.tasks import update_repo_branch_protection
+
+# Per repository work a worker can lease, in the order they run for a repository
+QUEUE_TASKS = {
+    "settings": OrganizerRepository.update_settings,
+    "default_branch": OrganizerRepository.update_default_branch,
+    "labels": OrganizerRepository.update_labels,
+    "security": OrganizerRepository.update_security_scanning,
+    "branch_protection": update_repo_branch_protection,
+}
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_LEASE_COUNT = 10
+# Seconds a failed item waits before it can be leased again
+RETRY_DELAY = 30
+
+# Rollback journal instead of WAL, so the queue also works on shared storage
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    repository TEXT NOT NULL,
+    task TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    available REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    result TEXT,
+    error TEXT,
+    UNIQUE (repository, task)
+);
+CREATE INDEX IF NOT EXISTS items_available ON items (state, available);
+"""
+
+
+class QueueError(Exception):
+    """Raised when a queue file can't be used"""
+
+
+class WorkQueue:
+    """Repository tasks stored in SQLite, leased to workers until acknowledged"""
+
+    def __init__(self, path: str, max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        """Initialize Class"""
+        self.max_attempts = max_attempts
+        try:
+            # Autocommit, every change below runs in an explicit transaction
+            self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+            self.connection.executescript(SCHEMA)
+        except sqlite3.Error as exception:
+            raise QueueError(f"{path} is not a work queue: {exception}") from exception
+
+    def get_login(self) -> str:
+        """Get the organization the queue was filled for"""
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'login'"
+        ).fetchone()
+        return row and row[0]
+
+    def enqueue(self, login: str, names, tasks: list) -> int:
+        """Add the tasks of every repository, skipping the ones already queued"""
+        current = self.get_login()
+        if current and current.lower() != login.lower():
+            raise QueueError(f"The queue is already filled for {current}")
+        self.connection.execute(
+            "INSERT OR IGNORE INTO meta VALUES ('login', ?)", (login,)
+        )
+        added = 0
+        names = iter(names)
+        # Commits per chunk, so workers can start while the listing continues
+        while True:
+            chunk = [(name, task) for name in islice(names, 100) for task in tasks]
+            if not chunk:
+                return added
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                added += self.connection.executemany(
+                    "INSERT OR IGNORE INTO items (repository, task) VALUES (?, ?)",
+                    chunk,
+                ).rowcount
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def lease(self, worker: str, count: int, seconds: float) -> list:
+        """Lease queued items and items whose lease expired to a worker"""
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            # Items that keep expiring, like a crashing worker, are given up on
+            self.connection.execute(
+                "UPDATE items SET state = 'failed', error = 'Lease expired' "
+                "WHERE state = 'leased' AND available <= ? AND attempts >= ?",
+                (now, self.max_attempts),
+            )
+            items = self.connection.execute(
+                "SELECT id, repository, task FROM items "
+                "WHERE state IN ('queued', 'leased') AND available <= ? "
+                "ORDER BY repository, id LIMIT ?",
+                (now, count),
+            ).fetchall()
+            self.connection.executemany(
+                "UPDATE items SET state = 'leased', worker = ?, available = ?, "
+                "attempts = attempts + 1 WHERE id = ?",
+                [(worker, now + seconds, item[0]) for item in items],
+            )
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return items
+
+    def extend(self, item_id: int, worker: str, seconds: float) -> bool:
+        """Renew the lease of an item, False if it was lost to another worker"""
+        return bool(
+            self.connection.execute(
+                "UPDATE items SET available = ? "
+                "WHERE id = ? AND worker = ? AND state = 'leased'",
+                (time.time() + seconds, item_id, worker),
+            ).rowcount
+        )
+
+    def ack(self, item_id: int, worker: str, result: dict) -> bool:
+        """Mark an item done, False if its lease was lost to another worker"""
+        return bool(
+            self.connection.execute(
+                "UPDATE items SET state = 'done', result = ?, error = NULL "
+                "WHERE id = ? AND worker = ? AND state = 'leased'",
+                (json.dumps(result), item_id, worker),
+            ).rowcount
+        )
+
+    def fail(self, item_id: int, worker: str, error: str) -> bool:
+        """Queue a failed item for a retry, or give up after the last attempt"""
+        return bool(
+            self.connection.execute(
+                "UPDATE items SET error = ?, available = ?, "
+                "state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END "
+                "WHERE id = ? AND worker = ? AND state = 'leased'",
+                (error, time.time() + RETRY_DELAY, self.max_attempts, item_id, worker),
+            ).rowcount
+        )
+
+    def is_finished(self) -> bool:
+        """Check if every item is either done or failed"""
+        return not self.connection.execute(
+            "SELECT 1 FROM items WHERE state IN ('queued', 'leased') LIMIT 1"
+        ).fetchone()
+
+    def get_report(self) -> dict:
+        """Merge the results of every worker into a single report"""
+        report = {"tasks": {}, "workers": {}, "failures": []}
+        rows = self.connection.execute(
+            "SELECT repository, task, state, worker, result, error FROM items"
+        )
+        for repository, task, state, worker, result, error in rows:
+            states = report["tasks"].setdefault(task, {})
+            states[state] = states.get(state, 0) + 1
+            if state == "done":
+                seconds = json.loads(result)["seconds"]
+                done, total = report["workers"].get(worker, (0, 0))
+                report["workers"][worker] = (done + 1, total + seconds)
+            elif state == "failed":
+                report["failures"].append((repository, task, error))
+        return report
+
+
+def get_worker_id() -> str:
+    """Get a worker name that is unique across machines"""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def fill_queue(org: OrganizerOrganization, queue: WorkQueue, tasks: list) -> int:
+    """Queue the tasks of every repository of an organization"""
+    names = (record.name for record in stream_records(org))
+    return queue.enqueue(org.login, names, tasks)
+
+
+def run_worker(
+    org: OrganizerOrganization,
+    queue: WorkQueue,
+    worker: str,
+    lease_seconds: float = DEFAULT_LEASE_SECONDS,
+    count: int = DEFAULT_LEASE_COUNT,
+    poll: float = 5,
+):
+    """Lease, apply and acknowledge items until the queue is finished"""
+    processed = 0
+    while True:
+        items = queue.lease(worker, count, lease_seconds)
+        if not items:
+            if queue.is_finished():
+                return processed
+            # Other workers hold the remaining leases, which may still expire
+            time.sleep(poll)
+            continue
+        repo = None
+        for item_id, repository, task in items:
+            # Earlier tasks of the batch use up the lease, so it restarts per task
+            if not queue.extend(item_id, worker, lease_seconds):
+                print(f"Lease of {task} for {org.login}/{repository} expired")
+                continue
+            started = time.monotonic()
+            try:
+                # Leases are ordered by repository, so tasks share the API object
+                if repo is None or repo.name != repository:
+                    repo = org.get_repository(repository)
+                if repo is None:
+                    raise GithubException(404, f"{repository} was not found", None)
+                QUEUE_TASKS[task](repo)
+            except Exception as exception:
+                # Any failure goes back to the queue instead of stopping the worker
+                print(f"Error running {task} for {org.login}/{repository}: {exception}")
+                queue.fail(item_id, worker, str(exception))
+                continue
+            result = {"seconds": time.monotonic() - started}
+            if not queue.ack(item_id, worker, result):
+                print(f"Lease of {task} for {org.login}/{repository} expired")
+            processed += 1